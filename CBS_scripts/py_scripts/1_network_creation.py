@@ -44,6 +44,10 @@ pd.options.mode.chained_assignment = None
  
 bipartite_data_path = "H:/data_overload/network_creation/data/bipartite" 
 projected_data_path = "H:/data_overload/network_creation/data/projected"
+sharded_data_path = "H:/data_overload/network_creation/data/projected_sharded"
+DRY_RUN = False #If True, only plan the projections (pairs, output size, peak memory) without creating any pair
+max_pairs_group = 10_000_000 #Groups with more pairs are flagged and projected in chunks
+memory_budget = 32 * 10**9 #Bytes of memory available for a projection (larger projections are only done in chunks)
 
 ## Read data into memory
 # Path definitions and global variables
@@ -78,8 +82,7 @@ vars_education_bo = ["RINPERSOONS", #if RINPERSOON available or not
 #basis = ['B 00101 basisonderwijs groep 3-8', 'B 00100 basisonderwijs groep 1-2', 'B 00200 speciaal basisonderwijs groep 1-2', 'B 00201 speciaal basisonderwijs groep 3-8']
 for year in range(2000,2022):
     education_registration = read_file_current_version("G:\Onderwijs\ONDERWIJSINSCHRTAB", year)
-    education_registration["AANVINSCHR"] = education_registration["AANVINSCHR"].astype(int)
-    education_registration["EINDINSCHR"] = education_registration["EINDINSCHR"].replace("Niet uitgeschreven",99999999).astype(int) #Consistency between years
+    education_registration = normalize_columns(education_registration, ["AANVINSCHR","EINDINSCHR"]) #Consistency between years (see SCHEMA)
     if "VO" in education_registration["TYPEONDERWIJS"].cat.categories:
         #Voortzet
         basis = filter_education(education_registration, vars_education_vo, type_ed = "VO")
@@ -106,8 +109,8 @@ for year in range(2000,2022):
 
 ## Save data for students in 8th grade (last year of primary school)
 #We will need this file when we are creating student pairs
-df = pd.read_csv(f"{bipartite_data_path}/bo_2019.tsv", sep="\t", dtype=str)
-df = df.loc[(df["WPOLEERJAAR"]==" 8")&(df["WPOVERBLIJFSJRBO"]==" 8")]
+df = read_tsv_typed(f"{bipartite_data_path}/bo_2019.tsv")
+df = df.loc[(df["WPOLEERJAAR"]==8)&(df["WPOVERBLIJFSJRBO"]==8)]
 df.to_csv(f"{bipartite_data_path}/bo_2019_last_year.tsv", sep="\t", index=None)
 
 
@@ -116,6 +119,7 @@ files_to_proyect = [_ for _ in os.listdir(bipartite_data_path) if (".tsv" in _)]
 files_to_proyect = [_ for _ in files_to_proyect if "2020" in _] #Only 2020 is needed for this paper
 
 
+verdicts = {}
 for file in files_to_proyect:
     if "bo" in file:
         columns_school = ["WPOBRIN_crypt","WPOBRINVEST","WPOLEERJAAR","WPOOPLNR","WPODENOMINATIE"]
@@ -124,10 +128,43 @@ for file in files_to_proyect:
         columns_school = ["BRIN_crypt","VOBRINVEST","VOLEERJAAR","OPLNR"]
         year_var = "VOLEERJAAR"
     path = f"F:/data_overload/network_creation/data/bipartite/{file}"
-    project_network(path, f"{projected_data_path}/{file}", columns_school, year_var)
+
+    # Plan the projection from the group keys only (exact pairs per group, output size and memory)
+    plan = plan_projection(path, columns_school, year_var, max_pairs_group=max_pairs_group)
+    plan.to_csv(f"{projected_data_path}/plan_{file}", sep="\t", index=None)
+    try:
+        method = choose_projection(plan, year_var, memory_budget, max_pairs_chunk=max_pairs_group) #Raises MemoryError if not even a chunk fits
+    except MemoryError as error:
+        if not DRY_RUN:
+            raise
+        print(error)
+        method = "too_large"
+    verdicts[file] = method
+    if DRY_RUN:
+        continue
+
+    if method == "full":
+        project_network(path, f"{projected_data_path}/{file}", columns_school, year_var)
+    else:
+        print(f"Skipping project_network for {file} (over the memory budget), read the pairs with read_projected_groups")
+    # Same pairs, sharded by year and BRIN with an index to read single groups (read_projected_groups)
+    project_network_sharded(path, f"{sharded_data_path}/{file[:2]}", int(file[3:7]), columns_school, year_var, max_pairs_chunk=max_pairs_group)
 
 
 
 
 
 
+## Weighted projection across all years (weight = number of years two students shared a group)
+files_weighted = {}
+for file in sorted(os.listdir(bipartite_data_path)):
+    if (".tsv" not in file) or ("last_year" in file):
+        continue
+    if "bo" in file:
+        files_weighted[f"{bipartite_data_path}/{file}"] = (["WPOBRIN_crypt","WPOBRINVEST","WPOLEERJAAR","WPOOPLNR","WPODENOMINATIE"], "WPOLEERJAAR")
+    else:
+        files_weighted[f"{bipartite_data_path}/{file}"] = (["BRIN_crypt","VOBRINVEST","VOLEERJAAR","OPLNR"], "VOLEERJAAR")
+if DRY_RUN:
+    print(pd.Series(verdicts, name="projection"))
+else:
+    project_network_weighted(files_weighted, f"{projected_data_path}/weighted_2000_2021.tsv")
@@ -40,16 +40,15 @@ temp_data = "T:/"
 
 # Read addresses of the educational site in 2020
 addressen = read_file_current_version("G:\Onderwijs\BRINADRESSEN", 2020)[["BRIN_crypt","BRINVest","RINObjectnummer","gemcode","POSTCODE","PLAATSNAAM"]]
-addressen = addressen.rename(columns={"BRINVest":"BRINVEST"})
+addressen = normalize_columns(addressen.rename(columns={"BRINVest":"BRINVEST"}))
 
 ## GROUP 2-4: Students together in primary school
 
 ## Merge students who are in VO in 2020 
 # Read secondary education (grade 9 only)
-vo = pd.read_csv(f"{bipartite_data_path}/vo_2020.tsv", sep="\t", dtype=str)
-vo = vo.loc[(vo["VOLEERJAAR"]=="leerjaar 1")]
+vo = read_tsv_typed(f"{bipartite_data_path}/vo_2020.tsv") # typed and normalized with SCHEMA (e.g. BRINVEST "geen codelijst" -> "00")
+vo = vo.loc[(vo["VOLEERJAAR"]==1)]
 vo = vo.rename(columns={"VOBRINVEST": "BRINVEST"})
-vo["BRINVEST"] = vo["BRINVEST"].replace('geen codelijst beschikbaar, zie externe link',"00")
 vo = vo.loc[~vo["RINPERSOON"].duplicated(keep=False)].dropna(subset=["RINPERSOON"]) #Remove students that went to two schools that year
 print(vo.shape)
 vo = pd.merge(vo, addressen, how="left", on=["BRIN_crypt","BRINVEST"], validate="m:1")
@@ -57,13 +56,10 @@ print(vo.shape)
 print("VO cleaned")
 
 # Read primary education (grade 8 only)
-bo = pd.read_csv(f"{projected_data_path}/bo_2019_last_year.tsv", sep="\t", dtype=str) #only students in the last year studying 8 years in the same place
+bo = read_tsv_typed(f"{projected_data_path}/bo_2019_last_year.tsv") #only students in the last year studying 8 years in the same place
 bo = bo.rename(columns={"WPOBRIN_crypt":"BRIN_crypt", "WPOBRINVEST": "BRINVEST"})
-bo["BRINVEST"] = bo["BRINVEST"].replace('geen codelijst beschikbaar, zie externe link',"00")
 print(bo.shape)
 bo = pd.merge(bo, addressen, how="left", on=["BRIN_crypt","BRINVEST"],validate="m:1")
-bo["RINPERSOON1"] = bo["RINPERSOON1"].str.strip()
-bo["RINPERSOON2"] = bo["RINPERSOON2"].str.strip()
 
 print(bo.shape)
 print("BO cleaned")
@@ -82,14 +78,17 @@ bo.to_csv(f"{data_path}/matching_analysis.tsv", sep="\t", index=None)
 # Addresses of students in 2021 (make sure the students remain all year)
 addressen = read_file_current_version("G:\Bevolking\GBAADRESOBJECTBUS", 2021)
 display(addressen.head(1))
-# drop rows before 2021
-addressen = addressen.loc[addressen["GBADATUMAANVANGADRESHOUDING"]<"20210000"]
+# Index of the address histories, to look up the address of anyone at any date (also used in 3_analysis.py)
+address_index = build_address_index(addressen)
+pickle.dump(address_index, open(f"{temp_data}/address_index.pkl", "wb+"))
+del addressen
 
 
-# Find our sample (students transitioning) and keep their last address
-students = set(np.unique(np.concatenate([bo["RINPERSOON1"],bo["RINPERSOON2"]])))
-addressen = addressen.loc[addressen["RINPERSOON"].isin(students),["RINPERSOON","RINOBJECTNUMMER"]]
-addressen = addressen.drop_duplicates(subset=["RINPERSOON"], keep="last")
+# Find our sample (students transitioning) and keep their last address before 2021
+students = np.unique(np.concatenate([bo["RINPERSOON1"],bo["RINPERSOON2"]]))
+addressen = pd.DataFrame({"RINPERSOON": students,
+                          "RINOBJECTNUMMER": lookup_address(address_index, students, 20201231, only_current=False)})
+addressen = addressen.dropna(subset=["RINOBJECTNUMMER"])
 
 len(students), len(addressen)
 
@@ -156,6 +155,8 @@ print((baseline["POSTCODE1"] == baseline["POSTCODE2"]).value_counts())
 print((bo["POSTCODE1"] == bo["POSTCODE2"]).value_counts())
 
 # Save to temp
+memory_report(bo, "Student pairs")
+memory_report(baseline, "Baseline pairs")
 pickle.dump(bo, open(f"{temp_data}/student_pairs.csv", "wb+"))
 pickle.dump(baseline, open(f"{temp_data}/student_pairs_baseline.csv", "wb+"))
 
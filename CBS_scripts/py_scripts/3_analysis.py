@@ -27,6 +27,8 @@ pd.options.mode.chained_assignment = None
 
 data_path = "H:/data_overload/network_creation/data/" 
 temp_data = "T:/"
+path_rivm = "G:\\Maatwerk\\CORONIT\\CoronIT_GGD_testdata_20210921.sav"
+path_infection_store = f"{data_path}/infection_store"
 
 import numpy as np
 from statsmodels.stats.proportion import proportion_confint
@@ -62,60 +64,31 @@ def calc_prop(df):
 
 
 
-def save_calc_prop(df, schools=True, label="", data_path="data_path"):
+def save_stats(stats, data_path="data_path"):
     """
-    Saves calculated proportions and statistics to a file for different distance thresholds and conditions.
+    Prints and saves the number of pairs and co-infected pairs for different distance thresholds and conditions.
 
-    This function calculates and saves the proportion of co-infected individuals 
-    for various distance thresholds and optionally for specific grouping conditions (e.g., within the same school or municipality). 
-    Results are appended to a tab-separated values (TSV) file.
+    Results are appended to a tab-separated values (TSV) file, together with the 95% confidence 
+    interval of the proportion (printed only).
 
     Args:
-        df (pd.DataFrame): A DataFrame containing columns `distance`, `co_infected`, 
-                           `POSTCODE1`, `POSTCODE2`, `gemcode1`, and `gemcode2`.
-        schools (bool, optional): If True, includes calculations for cases within the same school 
-                                  (`POSTCODE1` == `POSTCODE2`) and municipality (`gemcode1` == `gemcode2`). Defaults to True.
-        label (str, optional): A label to prepend to each row of output for context. Defaults to an empty string.
+        stats (pd.DataFrame): Counts with columns `Group`, `Distance`, `N` and `N_inf` 
+                              (see `calc_stats` and `merge_stats` in common_functions).
         data_path (str, optional): Path to the directory where the output file (`stats_full.tsv`) is saved. 
                                    Defaults to "data_path".
 
     Returns:
         None: The function appends results to a file and prints statistics to the console.
-
-    Notes:
-        - The `distance` column is used to group data into predefined thresholds.
-        - The output file is named `stats_full.tsv` and is tab-separated.
-
     """
     # Open the output file in append mode
     with open(f"{data_path}/stats_full.tsv", "a+") as f:
-        # General statistics for the entire dataset
-        print(f"General prob (N={len(df)}) {calc_prop(df)} {df['co_infected'].sum()}")
-        f.write(f"{label}\tgeneral\t{len(df)}\t{df['co_infected'].sum()}\n")
-            
-        # Threshold ranges for distance calculations
-        th_p = -1
-        for threshold in [0, 300, 1000, 3000, 10000, 30000, 300000]:
-            # Filter rows based on the current distance threshold range
-            d_th = df.loc[(df['distance'] > th_p) & (df['distance'] <= threshold)]
-            print(f"Within ({th_p}-{threshold}] meters (N={len(d_th)}) {calc_prop(d_th)} {d_th['co_infected'].sum()}")
-            f.write(f"{label}\t{th_p}-{threshold}\t{len(d_th)}\t{d_th['co_infected'].sum()}\n")
-            th_p = threshold  # Update the previous threshold for the next iteration
-        
-        # Additional grouping calculations if `schools` is True
-        if schools:
-            # Calculate for individuals within the same postcode
-            d_th = df.loc[df['POSTCODE1'] == df['POSTCODE2']]
-            print(f"Within postcode (N={len(d_th)}) {calc_prop(d_th)} {d_th['co_infected'].sum()}")
-            f.write(f"{label}\tschool_postcode\t{len(d_th)}\t{d_th['co_infected'].sum()}\n")
-
-            # Calculate for individuals within the same municipality (gemeente)
-            d_th = df.loc[df['gemcode1'] == df['gemcode2']]
-            print(f"Within gemeente (N={len(d_th)}) {calc_prop(d_th)} {d_th['co_infected'].sum()}")
-            f.write(f"{label}\tschool_gemeente\t{len(d_th)}\t{d_th['co_infected'].sum()}\n")
-
-# Read RIMV data
-rivm = read_rivm(only_positives=True)
+        for label, distance, N, N_inf in stats[["Group","Distance","N","N_inf"]].values:
+            print(f"{label} {distance} (N={N}) {100*np.array(proportion_confint(N_inf, N))} {N_inf}")
+            f.write(f"{label}\t{distance}\t{N}\t{N_inf}\n")
+
+# Read RIMV data (through the append-only store, newer extracts are added with 4_update_infections.py)
+update_infection_store(path_infection_store, path_rivm, only_positives=True)
+rivm = read_infection_store(path_infection_store)
 
 
 
@@ -129,152 +102,94 @@ set_siblings = set(df_jan_fam["RINPERSOONSRC"]+df_jan_fam["RINPERSOONDST"])
 # Read groups 1-4 (from script 2)
 bo = pickle.load(open(f"{temp_data}/student_pairs.csv", "rb"))
 baseline = pickle.load(open(f"{temp_data}/student_pairs_baseline.csv", "rb"))
+address_index = pickle.load(open(f"{temp_data}/address_index.pkl", "rb"))
+memory_report(bo, "Student pairs")
 
+# Coordinates of the addresses (100x100 square)
+coord = read_file_current_version("G:\BouwenWonen\VSLVIERKANTTAB", 2022, usecols=["RINOBJECTNUMMER", "VRLVIERKANT100M"])
+coord = coord.drop_duplicates(subset=["RINOBJECTNUMMER"]).set_index("RINOBJECTNUMMER")["VRLVIERKANT100M"]
 
-
-# When the students live in the same house the distance should be 0
-bo.loc[bo["RINOBJECTNUMMER"]==bo["RINOBJECTNUMMER2"], "distance"] = 0
-baseline.loc[baseline["RINOBJECTNUMMER"]==baseline["RINOBJECTNUMMER2"], "distance"] = 0
-
-
-# Add first infection date
-bo["date_infection_1"] = bo["RINPERSOON1"].map(rivm)
-bo["date_infection_2"] = bo["RINPERSOON2"].map(rivm)
-
-baseline["date_infection_1"] = baseline["RINPERSOON1"].map(rivm)
-baseline["date_infection_2"] = baseline["RINPERSOON2"].map(rivm)
-
-
-# Temporally associated infections
 threshold = 14
-bo["co_infected"] = ((bo["date_infection_1"]-bo["date_infection_2"]).abs() < threshold)
-baseline["co_infected"] = ((baseline["date_infection_1"]-baseline["date_infection_2"]).abs() < threshold)
-
-
-
-# test the threshold
-sns.distplot((baseline["date_infection_1"]-baseline["date_infection_2"]), hist=False)
-sns.distplot((bo["date_infection_1"]-bo["date_infection_2"]),hist=False)
-plt.plot([-7,-7],[0,0.004])
-plt.plot([7,7],[0,0.004])
-
-
-# Not infected
-bo["not_infected"] = np.isnan(bo["date_infection_1"]) & np.isnan(bo["date_infection_2"]) 
-baseline["not_infected"] = np.isnan(baseline["date_infection_1"]) & np.isnan(baseline["date_infection_2"]) 
-
-
-# Add two ID columns to improve efficiency
-bo["pair"] = bo["RINPERSOON1"] + bo["RINPERSOON2"]
-baseline["pair"] = baseline["RINPERSOON1"] + baseline["RINPERSOON2"]
 
 
 # Create samples (groups 1-4, note that the group numbers do not correspond to the paper)
-# Same class vo
-filter_ = ((bo["BRIN_crypt1"] == bo["BRIN_crypt2"]) & (bo["OPLNR"] == bo["OPLNR2"]) & (bo["BRINVEST1"] == bo["BRINVEST2"]))
-print(filter_.sum())
-type1_same_class = bo.loc[filter_]
-
-# Different class vo
-filter_ = ((bo["BRIN_crypt1"] == bo["BRIN_crypt2"]) & (bo["OPLNR"] != bo["OPLNR2"]) & (bo["BRINVEST1"] == bo["BRINVEST2"]))
-print(filter_.sum())
-type2_diff_class = bo.loc[filter_]
-
-# Different school / same institution
-filter_ = ((bo["BRIN_crypt1"] == bo["BRIN_crypt2"]) & (bo["BRINVEST1"] != bo["BRINVEST2"]))
-print(filter_.sum())
-type3_same_inst = bo.loc[filter_]
-
-
-# Different school vo
-filter_ = (bo["BRIN_crypt1"] != bo["BRIN_crypt2"])
-print(filter_.sum())
-type4_diff_school = bo.loc[filter_]
+# - same_class: same school (BRIN and BRINVEST) and program
+# - same_school: same school, different program
+# - same_institution: same BRIN, different BRINVEST
+# - different_inst: different BRIN
+same_brin = (bo["BRIN_crypt1"] == bo["BRIN_crypt2"])
+same_vest = (bo["BRINVEST1"] == bo["BRINVEST2"])
+bo["Group"] = np.select([same_brin & same_vest & (bo["OPLNR"] == bo["OPLNR2"]),
+                         same_brin & same_vest & (bo["OPLNR"] != bo["OPLNR2"]),
+                         same_brin & ~same_vest,
+                         ~same_brin],
+                        ["same_class", "same_school", "same_institution", "different_inst"], default="")
+bo = bo.loc[bo["Group"] != ""]
+del same_brin, same_vest
+print(bo["Group"].value_counts())
 
 # Random sample (for comparison)
+baseline["Group"] = "baseline"
 print(baseline.shape)
 
-
-# Calculate proportions in general
-print("Type 1, same class")
-save_calc_prop(type1_same_class, label="same_class_all")
-
-print("\nType 2, different class, same school")
-save_calc_prop(type2_diff_class, label="same_school_all")
-
-print("\nType 3, different school same institution")
-save_calc_prop(type3_same_inst, label="same_institution_all")
-
-print("\nType 4, different school")
-save_calc_prop(type4_diff_school, label="different_inst_all")
-
-print("\nType 4, baseline")
-save_calc_prop(baseline, label="baseline_all")
-
-
-# Calculate proportions  for twins
-print("Type 1, same class")
-save_calc_prop(type1_same_class.loc[type1_same_class["pair"].isin(set_siblings)], label="same_class_twins")
-
-print("\nType 2, different class, same school")
-save_calc_prop(type2_diff_class.loc[type2_diff_class["pair"].isin(set_siblings)],  label="same_school_twins")
-
-print("\nType 3, different school same institution")
-save_calc_prop(type3_same_inst.loc[type3_same_inst["pair"].isin(set_siblings)], label="same_institution_twins")
-
-print("\nType 4, different school")
-save_calc_prop(type4_diff_school.loc[type4_diff_school["pair"].isin(set_siblings)], label="different_inst_twins")
-
-print("\nType 4, baseline")
-save_calc_prop(baseline.loc[baseline["pair"].isin(set_siblings)], label="baseline_twins")
-
-# Calculate proportions of infections in general 
-print("Type 1, same class")
-save_calc_prop(type1_same_class.loc[~type1_same_class["not_infected"]], label="same_class_infected")
-
-print("\nType 2, different class, same school")
-save_calc_prop(type2_diff_class.loc[~type2_diff_class["not_infected"]],  label="same_school_infected")
-
-print("\nType 3, different school same institution")
-save_calc_prop(type3_same_inst.loc[~type3_same_inst["not_infected"]], label="same_institution_infected")
-
-print("\nType 4, different school")
-save_calc_prop(type4_diff_school.loc[~type4_diff_school["not_infected"]], label="different_inst_infected")
-
-print("\nType 4, baseline")
-save_calc_prop(baseline.loc[~baseline["not_infected"]], label="baseline_infected")
-
-
-# Calculate proportions of infections in general
-print("Type 1, same class")
-save_calc_prop(type1_same_class.loc[(~type1_same_class["not_infected"])&type1_same_class["pair"].isin(set_siblings)], label="same_class_infected_twins")
-
-print("\nType 2, different class, same school")
-save_calc_prop(type2_diff_class.loc[(~type2_diff_class["not_infected"])&type2_diff_class["pair"].isin(set_siblings)],  label="same_school_infected_twins")
-
-print("\nType 3, different school same institution")
-save_calc_prop(type3_same_inst.loc[(~type3_same_inst["not_infected"])&type3_same_inst["pair"].isin(set_siblings)], label="same_institution_infected_twins")
-
-print("\nType 4, different school")
-save_calc_prop(type4_diff_school.loc[(~type4_diff_school["not_infected"])&type4_diff_school["pair"].isin(set_siblings)], label="different_inst_infected_twins")
-
-print("\nType 4, baseline")
-save_calc_prop(baseline.loc[(~baseline["not_infected"])&baseline["pair"].isin(set_siblings)], label="baseline_infected_twins")
+# Keep the pairs of every group to update the co-infection counts incrementally
+pairs_groups = [bo[["Group","RINPERSOON1","RINPERSOON2"]], baseline[["Group","RINPERSOON1","RINPERSOON2"]]]
+
+
+# Calculate proportions (all, twins, infected, infected twins), partitioned by gemeente and run in parallel. 
+# The workers add the infections, the distance at the infection date and the co-infections of their partition.
+groups_school = ["same_class", "same_school", "same_institution", "different_inst", "baseline"]
+columns_school = ["Group","RINPERSOON1","RINPERSOON2","RINOBJECTNUMMER","RINOBJECTNUMMER2","BRIN_crypt","BRINVEST",
+                  "distance","POSTCODE1","POSTCODE2","gemcode1","gemcode2"]
+bo = bo[columns_school + ["gemcode"]]
+baseline = baseline[columns_school + ["gemcode"]]
+
+# Write every partition to disk (the workers load their own slice, the parent does not keep the pairs)
+rivm_series = pd.Series(rivm)
+rows_bo = bo.groupby(bo["gemcode"].astype(str)).indices #Missing gemeentes as "nan"
+rows_baseline = baseline.groupby(baseline["gemcode"].astype(str)).indices
+partitions, gemcodes = [], []
+for i, key in enumerate(sorted(set(rows_bo) | set(rows_baseline))):
+    gemcode = None if key == "nan" else key
+    gemcodes.append(gemcode)
+    part = pd.concat([bo.iloc[rows_bo.get(key, [])], baseline.iloc[rows_baseline.get(key, [])]], ignore_index=True)
+    persons = pd.unique(np.concatenate([part["RINPERSOON1"].values, part["RINPERSOON2"].values]))
+    address_part = subset_address_index(address_index, persons)
+    partitions.append(write_partition(f"{temp_data}/partitions/school_{i}.pkl",
+                                      pairs=part[columns_school],
+                                      rivm=subset_infections(rivm_series, persons),
+                                      siblings=set_siblings.intersection(part["RINPERSOON1"] + part["RINPERSOON2"]),
+                                      groups=groups_school,
+                                      address_index=address_part,
+                                      coord=coord.reindex(pd.unique(address_part["object"])).dropna(),
+                                      threshold=threshold,
+                                      gemcode=gemcode))
+del bo, baseline, rows_bo, rows_baseline, part, persons, address_part
+results = run_partitioned(school_partition_stats, partitions)
+save_stats(merge_stats([stats for stats, _, _ in results]), data_path=data_path)
+
+# Keep the counts per gemeente (cluster) for the cluster bootstrap, and the aggregated pairs for the query layer
+stats_clusters_school = pd.concat([stats.assign(cluster=gemcode) for gemcode, (stats, _, _) in zip(gemcodes, results)], ignore_index=True)
+aggregates = [aggregates for _, aggregates, _ in results]
+
+# Aggregated binomial cells (group, primary school, gemeente, distance) for the multilevel model (5_fit_glmm.py)
+cells = pd.concat([cells for _, _, cells in results], ignore_index=True)
+cells.to_csv(f"{data_path}/glmm_cells.tsv", sep="\t", index=None)
+print(f"{len(cells)} cells for {cells['N'].sum()} pairs")
+del partitions, results, cells
 
 
 ## CAlculate temporally associated infections for family
 
 
-# Addresses of people
-addressen = read_file_current_version("G:\Bevolking\GBAADRESOBJECTBUS", 2021, usecols=["RINPERSOON","GBADATUMAANVANGADRESHOUDING","GBADATUMEINDEADRESHOUDING","RINOBJECTNUMMER"])
-# drop rows before 2021
-addressen = addressen.loc[addressen["GBADATUMAANVANGADRESHOUDING"]<"20210000"]
-addressen = addressen.loc[addressen["GBADATUMEINDEADRESHOUDING"]>"20210000"] #still living in the house
-addressen = addressen.drop_duplicates(subset=["RINPERSOON"], keep="last")
+# Addresses of people (still living in the house at the end of 2020), from the index of address histories (script 2)
+addressen = pd.DataFrame({"RINPERSOON": address_index["persons"],
+                          "RINOBJECTNUMMER": lookup_address(address_index, address_index["persons"], 20201231)})
+addressen = addressen.dropna(subset=["RINOBJECTNUMMER"])
 # Merge addresses to coordinates (100x100 square)
-coord = read_file_current_version("G:\BouwenWonen\VSLVIERKANTTAB", 2022, usecols=["RINOBJECTNUMMER", "VRLVIERKANT100M"]).drop_duplicates()
+coord = coord.reset_index()
 
-addressen = pd.merge(addressen[["RINPERSOON","RINOBJECTNUMMER"]], coord)
+addressen = pd.merge(addressen[["RINPERSOON","RINOBJECTNUMMER"]], coord).set_index("RINPERSOON")
 display(addressen.head(1))
 
 
@@ -287,31 +202,65 @@ df_jan_fam = read_csv(path_network, sep=";",dtype=str,usecols=["RINPERSOONSRC","
 df_jan_fam = df_jan_fam.loc[df_jan_fam["linktype"].isin({"102","103","104"})].compute()
     
 
-# Calculate proportions for different type of family pairs
+# Calculate proportions for different type of family pairs (in partitions of the source person, run in parallel)
+n_partitions = 64
 for label, code in zip(("Co-Parents", "Parent-child", "Siblings"), ("102", "104", "103")):
     print("\n\n", label)
     df = df_jan_fam.loc[df_jan_fam["linktype"]==code]
-    df["date_infection_1"] = df["RINPERSOONSRC"].map(rivm)
-    df["date_infection_2"] = df["RINPERSOONDST"].map(rivm)
-    print(len(df))
-
-    df = pd.merge(df, addressen.rename(columns={"RINPERSOON":"RINPERSOONSRC"}), on ="RINPERSOONSRC", validate="m:1")
     print(len(df))
-    df = pd.merge(df, addressen.rename(columns={"RINPERSOON":"RINPERSOONDST"}), on ="RINPERSOONDST", suffixes=["","2"], validate="m:1")
-    print(len(df))
-
 
-    df["co_infected"] = ((df["date_infection_1"]-df["date_infection_2"]).abs() < threshold)
-    df["not_infected"] = np.isnan(df["date_infection_1"]) & np.isnan(df["date_infection_2"]) 
-    df = df.loc[(df["VRLVIERKANT100M"].str[0] != "-") & (df["VRLVIERKANT100M2"].str[0] != "-")]
-    df = calculate_distance(df)
-    df.loc[df["RINOBJECTNUMMER"]==df["RINOBJECTNUMMER2"], "distance"] = 0
-    print(f"\n\n----------------------\nBetween {label} - all")
-    save_calc_prop(df, schools=False, label=f"{label}-{code}_all")
+    partitions = []
+    for i, (_, part) in enumerate(df.groupby(pd.util.hash_pandas_object(df["RINPERSOONSRC"], index=False).values % n_partitions)):
+        persons = pd.unique(np.concatenate([part["RINPERSOONSRC"].values, part["RINPERSOONDST"].values]))
+        partitions.append(write_partition(f"{temp_data}/partitions/family_{code}_{i}.pkl",
+                                          df=part,
+                                          rivm=subset_infections(rivm_series, persons),
+                                          addressen=addressen.loc[addressen.index.intersection(persons)].reset_index(),
+                                          label=f"{label}-{code}",
+                                          threshold=threshold))
+    del part, persons
+    results = run_partitioned(family_partition_stats, partitions)
     
-    print(f"----------------------\nBetween {label} - only infected")
-    save_calc_prop(df.loc[~df["not_infected"]], schools=False, label=f"{label}-{code}_infected")
+    print(f"\n\n----------------------\nBetween {label}")
+    save_stats(merge_stats([stats for stats, _, _ in results]), data_path=data_path)
+    pairs_groups += [pairs.assign(Group=f"{label}-{code}") for _, pairs, _ in results]
+    aggregates += [aggregates_family for _, _, aggregates_family in results]
     
+    del df, partitions, results
+
+
+## Indirect paths between school and family networks (sparse adjacency matrices)
+bo = pickle.load(open(f"{temp_data}/student_pairs.csv", "rb"))[["RINPERSOON1","RINPERSOON2","BRIN_crypt1","BRIN_crypt2","BRINVEST1","BRINVEST2","OPLNR","OPLNR2"]]
+persons = intern_persons(bo["RINPERSOON1"], bo["RINPERSOON2"], df_jan_fam["RINPERSOONSRC"], df_jan_fam["RINPERSOONDST"])
+siblings = pairs_to_csr(persons, *df_jan_fam.loc[df_jan_fam["linktype"]=="103", ["RINPERSOONSRC","RINPERSOONDST"]].values.T)
+parents = pairs_to_csr(persons, *df_jan_fam.loc[df_jan_fam["linktype"]=="104", ["RINPERSOONSRC","RINPERSOONDST"]].values.T)
+
+# Students in each VO program (persons x programs) and classmates (shared program)
+students_vo = pd.concat([
+    bo[["RINPERSOON1","BRIN_crypt1","BRINVEST1","OPLNR"]].set_axis(["RINPERSOON","BRIN_crypt","BRINVEST","OPLNR"], axis=1),
+    bo[["RINPERSOON2","BRIN_crypt2","BRINVEST2","OPLNR2"]].set_axis(["RINPERSOON","BRIN_crypt","BRINVEST","OPLNR"], axis=1)
+]).drop_duplicates()
+programs, program_index = group_incidence(persons, students_vo["RINPERSOON"], students_vo[["BRIN_crypt","BRINVEST","OPLNR"]])
+classmates = count_paths(programs, programs.T)
+print(f"{len(persons)} persons, {len(program_index)} programs, {classmates.nnz} classmate links")
+
+# Programs connected through siblings (household bridges)
+bridges = count_paths(programs.T, siblings, programs)
+print(f"{bridges.nnz//2} pairs of programs connected by siblings")
+
+# Co-infection through indirect paths (not directly connected)
+direct = classmates + siblings + parents
+for label, layers in (("classmate_of_sibling", (siblings, classmates)), ("parent_of_classmate", (classmates, parents))):
+    df = paths_to_pairs(count_paths(*layers, exclude=direct), persons)
+    df["date_infection_1"] = df["RINPERSOON1"].map(rivm)
+    df["date_infection_2"] = df["RINPERSOON2"].map(rivm)
+    df["co_infected"] = ((df["date_infection_1"]-df["date_infection_2"]).abs() < threshold)
+    df["not_infected"] = np.isnan(df["date_infection_1"]) & np.isnan(df["date_infection_2"]) 
+
+    with open(f"{data_path}/stats_full.tsv", "a+") as f:
+        for subset, d_th in (("all", df), ("infected", df.loc[~df["not_infected"]])):
+            print(f"{label} {subset} (N={len(d_th)}) {calc_prop(d_th)} {d_th['co_infected'].sum()}")
+            f.write(f"{label}_{subset}\tgeneral\t{len(d_th)}\t{d_th['co_infected'].sum()}\n")
     del df
 
 
@@ -321,8 +270,46 @@ df = pd.read_csv(f"{data_path}/stats_full.tsv", sep="\t", header=None)
 df.columns = ["Group","Distance","N","N_inf"]
 df.loc[df["N_inf"]<10, "N_inf"] = np.nan
 df.loc[df["N"]<10, "N"] = np.nan
+
+# Cluster-robust confidence intervals for school pairs (resampling gemeentes)
+stats_clusters_school.to_csv(f"{data_path}/stats_clusters.tsv", sep="\t", index=None)
+ci = cluster_bootstrap_ci(stats_clusters_school, n_boot=5000)
+df = pd.merge(df, ci[["Group","Distance","ci_low","ci_high"]], how="left", on=["Group","Distance"])
+cluster = df["ci_low"].notna()
+
+# Family and indirect pairs have no gemeente (the partitions are random), so they keep Wilson intervals (not cluster-robust)
+wilson = ~cluster & df["N_inf"].notna() & df["N"].notna()
+ci_low, ci_high = proportion_confint(df.loc[wilson, "N_inf"], df.loc[wilson, "N"], method="wilson")
+df.loc[wilson, "ci_low"], df.loc[wilson, "ci_high"] = 100*ci_low, 100*ci_high
+df.loc[df["N_inf"].isna() | df["N"].isna(), ["ci_low","ci_high"]] = np.nan
+df["ci_method"] = np.where(df["ci_low"].isna(), "suppressed", np.where(cluster, "cluster_gemeente", "wilson"))
 df.to_excel(f"{data_path}/stats.xlsx",index=None)
 
 
+## Save the aggregated pairs (queried with `query_aggregates`, see 6_query_aggregates.py)
+aggregate_store = build_aggregate_store(aggregates)
+pickle.dump(aggregate_store, open(f"{data_path}/aggregate_store.pkl", "wb+"))
+del aggregates
+
+# test the threshold (days between the infections of infected pairs, up to max_days)
+days = aggregate_store.reset_index()
+days = days.loc[(days["days"] >= 0) & days["Group"].isin(groups_school)]
+days = days.assign(baseline=days["Group"]=="baseline").groupby(["baseline","days"])["N"].sum()
+for is_baseline, label in ((True, "baseline"), (False, "school pairs")):
+    plt.plot(days[is_baseline].index, days[is_baseline] / days[is_baseline].sum(), label=label)
+plt.plot([7,7],[0,0.1])
+plt.plot([threshold,threshold],[0,0.1])
+plt.legend()
+
+
+## Save the co-infection counts per group and week, and the pairs to update them (4_update_infections.py)
+pairs_groups = pd.concat(pairs_groups, ignore_index=True)
+pair_index = index_pairs_by_person(pairs_groups)
+pickle.dump((pairs_groups, pair_index), open(f"{temp_data}/pairs_groups.pkl", "wb+"))
+
+counts = count_coinfections(pairs_groups, rivm, threshold=threshold)
+counts.reset_index().to_csv(f"{path_infection_store}/coinfection_counts.tsv", sep="\t", index=None)
+
+
 
 
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+#Imports
+import pickle
+
+import pandas as pd
+
+from common_functions import *
+
+pd.options.display.max_columns = 100
+
+data_path = "H:/data_overload/network_creation/data/" 
+temp_data = "T:/"
+path_infection_store = f"{data_path}/infection_store"
+
+# Newest RIVM extract, only the tests after the last processed date are ingested
+path_rivm = "G:\\Maatwerk\\CORONIT\\CoronIT_GGD_testdata_20211005.sav"
+threshold = 14
+
+
+# Infections and co-infection counts before the update (created by 3_analysis.py)
+rivm = read_infection_store(path_infection_store)
+counts = pd.read_csv(f"{path_infection_store}/coinfection_counts.tsv", sep="\t", dtype={"Group": str})
+counts = counts.set_index(["Group","period"])["N_inf"]
+print(counts.groupby("Group").sum())
+
+# Pairs of every group (and the person -> pair index)
+pairs_groups, pair_index = pickle.load(open(f"{temp_data}/pairs_groups.pkl", "rb"))
+
+
+# Ingest the new tests and update the counts of the pairs with a new infection
+new_infections = update_infection_store(path_infection_store, path_rivm, only_positives=True)
+counts = update_coinfection_counts(counts, pairs_groups, pair_index, rivm, new_infections, threshold=threshold)
+print(counts.groupby("Group").sum())
+
+
+## Save the updated counts (only this summary is incremental: re-run 3_analysis.py to update stats_full.tsv and aggregate_store.pkl)
+counts.reset_index().to_csv(f"{path_infection_store}/coinfection_counts.tsv", sep="\t", index=None)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+#Imports
+import os
+
+import pandas as pd
+
+from common_functions import *
+
+pd.options.display.max_columns = 100
+
+data_path = "H:/data_overload/network_creation/data/" 
+results_path = f"{data_path}/statistical_models"
+os.makedirs(results_path, exist_ok=True)
+
+
+# Aggregated binomial cells (created by 3_analysis.py), one row per group, school, gemeente and distance
+cells = pd.read_csv(f"{data_path}/glmm_cells.tsv", sep="\t", dtype={"Group": str, "gemcode": str, "school_id": str, "Distance": str})
+cells = cells.dropna(subset=["gemcode","school_id","Distance"])
+print(f"{len(cells)} cells for {cells['N'].sum()} pairs, {cells['N_inf'].sum()} co-infected")
+
+
+# Null model: (1 | gemcode) + (1 | gemcode:school_id), as m1_sch_nopro in analyses.Rmd
+m1 = fit_binomial_glmm(cells, fixed=[], random=[["gemcode"], ["gemcode","school_id"]])
+print(m1["fixef"])
+print(m1["varcorr"])
+
+# Model with predictors (type of pair and distance). Not the m2c model of analyses.Rmd (distanceS, school_sizeS, 
+# WPODENOMINATIE, income_post_meanS), so its tables are saved with their own names (m2_group_distance*)
+m2 = fit_binomial_glmm(cells, fixed=["Group","Distance"], random=[["gemcode"], ["gemcode","school_id"]])
+print(m2["fixef"])
+print(m2["varcorr"])
+
+
+## Export (same tables as analyses.Rmd)
+for label, model in (("m1_null", m1), ("m2_group_distance", m2)):
+    with pd.ExcelWriter(f"{results_path}/{label}.xlsx") as writer:
+        model["fixef"][["Estimate","Std. Error"]].to_excel(writer, sheet_name="fixef")
+        model["stats"].to_frame(label).to_excel(writer, sheet_name="stats")
+    model["varcorr"].to_excel(f"{results_path}/{label}_varcorr.xlsx", index=None)
+
+m2["vcov"].to_excel(f"{results_path}/m2_group_distance_vcov.xlsx", index=None)
+m2["ranef"].loc[m2["ranef"]["grpvar"]=="gemcode"].to_excel(f"{results_path}/m2_group_distance_ranf_gem.xlsx", index=None)
+m2["ranef"].loc[m2["ranef"]["grpvar"]=="gemcode:school_id"].to_excel(f"{results_path}/m2_group_distance_ranf_sch.xlsx", index=None)
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+
+#Imports
+import pickle
+
+import pandas as pd
+
+from common_functions import *
+
+pd.options.display.max_columns = 100
+
+data_path = "H:/data_overload/network_creation/data/"
+
+
+# Aggregated pairs (created by 3_analysis.py)
+store = pickle.load(open(f"{data_path}/aggregate_store.pkl", "rb"))
+print(store.index.get_level_values("Group").unique().tolist())
+
+
+## Proportions per group and distance (as in stats_full.tsv)
+display(query_aggregates(store, by=("Group", "Distance"), infected=True))
+
+
+## Distance ranges merged (as in `merge_two` in paper_figures.ipynb)
+distances = ["0-300", "300-1000", "1000-3000", "3000-10000"]
+display(query_aggregates(store, groups=["same_class", "same_school", "same_institution", "baseline"],
+                         infected=True, distances=distances))
+
+
+## School pairs in the same gemeente / postcode, with cluster-robust confidence intervals
+display(query_aggregates(store, by=("Group", "same_gemeente"), twins=False, infected=True, ci="cluster"))
+display(query_aggregates(store, by=("Group",), twins=False, infected=True, same_postcode=True))
+
+
+## Sensitivity to the threshold of temporally associated infections
+display(pd.concat([query_aggregates(store, infected=True, threshold=th).assign(threshold=th) for th in (7, 14, 21, 28)],
+                  ignore_index=True))
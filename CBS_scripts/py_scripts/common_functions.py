@@ -1,10 +1,20 @@
 import csv
+import io
 import os
+import pickle
 import numpy as np
 import pandas as pd
 import time
+import zlib
 
+from concurrent.futures import ProcessPoolExecutor
 from itertools import combinations
+from scipy import sparse
+from scipy.optimize import minimize
+from scipy.sparse.linalg import splu
+from scipy.special import expit
+from scipy.stats import norm
+from statsmodels.stats.proportion import proportion_confint
 
 
 def read_file_current_version(path, year, usecols=None, nrows=-1):
@@ -53,6 +63,165 @@ def read_file_current_version(path, year, usecols=None, nrows=-1):
                 raise Exception("File not in SPSS format. Code for other formats is not implemented.")
 
 
+def _brinvest(values):
+    """Codes the branch of the education site as "00" when no code list is available."""
+    return values.replace("geen codelijst beschikbaar, zie externe link", "00")
+
+
+def _end_registration(values):
+    """Codes registrations that have not ended with 99999999 (consistency between years)."""
+    return values.replace("Niet uitgeschreven", "99999999")
+
+
+def _school_year(values):
+    """Extracts the school year as a number ("leerjaar 1" -> 1, " 8" -> 8, "n.v.t." -> missing)."""
+    if pd.api.types.is_numeric_dtype(values):
+        return values
+    if pd.api.types.infer_dtype(values, skipna=True) == "string":
+        return values.str.extract(r"(\d+)", expand=False)
+    is_text = values.map(type).eq(str)
+    return values.where(~is_text, values.loc[is_text].str.extract(r"(\d+)", expand=False))
+
+
+def _strip_text(values):
+    """Strips the whitespace of the text values, keeping other values (e.g. the dates of a labelled SPSS column)."""
+    if pd.api.types.infer_dtype(values, skipna=True) == "string":
+        return values.str.strip()
+    is_text = values.map(type).eq(str)
+    return values.where(~is_text, values.loc[is_text].str.strip())
+
+
+# Types of the CBS columns used in the pipeline and the normalization applied before casting them.
+# Columns of pair tables with the suffix 1 or 2 (e.g. BRIN_crypt1, RINPERSOON2) use the same entry.
+SCHEMA = {
+    # Persons
+    "RINPERSOONS": ("category", None),
+    "RINPERSOON": (str, None),
+    "ONDERWIJSNR_crypt": (str, None),
+    # Schools and programs
+    "BRIN_crypt": ("category", None),
+    "WPOBRIN_crypt": ("category", None),
+    "BRINVEST": ("category", _brinvest),
+    "VOBRINVEST": ("category", _brinvest),
+    "WPOBRINVEST": ("category", _brinvest),
+    "OPLNR": ("category", None),
+    "WPOOPLNR": ("category", None),
+    "TYPEONDERWIJS": ("category", None),
+    "WPOTYPEPO": ("category", None),
+    "WPODENOMINATIE": ("category", None),
+    "VOLEERJAAR": ("Int8", _school_year),
+    "WPOLEERJAAR": ("Int8", _school_year),
+    "WPOVERBLIJFSJRBO": ("Int8", _school_year),
+    # Registration dates (YYYYMMDD) and derived columns (see `filter_education`)
+    "AANVINSCHR": ("Int32", None),
+    "EINDINSCHR": ("Int32", _end_registration),
+    "diff": ("Int32", None),
+    "year": ("Int16", None),
+    "month": ("Int8", None),
+    # Locations
+    "gemcode": ("category", None),
+    "POSTCODE": ("category", None),
+    "PLAATSNAAM": ("category", None),
+    "RINObjectnummer": (str, None),
+    "RINOBJECTNUMMER": (str, None),
+    "VRLVIERKANT100M": (str, None),
+}
+
+
+def column_schema(column):
+    """
+    Finds the type and normalization rule of a column in `SCHEMA`.
+
+    Args:
+        column (str): Name of the column. Suffixes 1 and 2 of pair tables are removed if needed.
+
+    Returns:
+        tuple: (dtype, rule), or None if the column is not in the schema.
+    """
+    if column in SCHEMA:
+        return SCHEMA[column]
+    if column[-1:] in ("1", "2") and column[:-1] in SCHEMA:
+        return SCHEMA[column[:-1]]
+    return None
+
+
+def normalize_columns(df, columns=None):
+    """
+    Normalizes the values of the columns in `SCHEMA` and casts them to compact types.
+
+    Text values are stripped of whitespace (other values, e.g. the dates of a labelled SPSS column, are 
+    kept as they are), the normalization rules of the schema are applied 
+    (e.g. `BRINVEST` "geen codelijst beschikbaar" -> "00", `EINDINSCHR` "Niet uitgeschreven" -> 99999999, 
+    `WPOLEERJAAR` " 8" -> 8) and the columns are cast to categoricals or (nullable) integers.
+
+    Args:
+        df (pd.DataFrame): The data to normalize (modified in place).
+        columns (list, optional): Columns to normalize. Defaults to all columns in the schema.
+
+    Returns:
+        pd.DataFrame: The normalized data.
+
+    Example:
+        >>> vo = normalize_columns(read_file_current_version("G:/Onderwijs/ONDERWIJSINSCHRTAB", 2020))
+    """
+    for column in (df.columns if columns is None else columns):
+        schema = column_schema(column)
+        if schema is None:
+            continue
+        dtype, rule = schema
+
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            values = values.astype(object)
+        if not pd.api.types.is_numeric_dtype(values):
+            values = _strip_text(values)
+        if rule is not None:
+            values = rule(values)
+
+        # Cast to the type of the schema
+        if dtype in ("Int8", "Int16", "Int32"):
+            values = pd.to_numeric(values, errors="coerce").round().astype(dtype)
+        elif dtype == "category":
+            values = values.astype("category")
+        df[column] = values
+
+    return df
+
+
+def read_tsv_typed(path, usecols=None, nrows=None):
+    """
+    Reads a tab-separated intermediate file and normalizes its columns with `SCHEMA`.
+
+    Args:
+        path (str): Path to the tab-separated file.
+        usecols (list, optional): Columns to read. Defaults to None (all).
+        nrows (int, optional): Number of rows to read. Defaults to None (all).
+
+    Returns:
+        pd.DataFrame: The data with compact types (see `normalize_columns`).
+    """
+    df = pd.read_csv(path, sep="\t", dtype=str, usecols=usecols, nrows=nrows)
+    return normalize_columns(df)
+
+
+def memory_report(df, name=""):
+    """
+    Prints and returns the memory used by every column of a table.
+
+    Args:
+        df (pd.DataFrame): The table.
+        name (str, optional): Name of the table in the printed summary. Defaults to an empty string.
+
+    Returns:
+        pd.DataFrame: One row per column with its `dtype` and memory use (`MB`), largest first.
+    """
+    report = pd.DataFrame({"dtype": df.dtypes.astype(str), "MB": df.memory_usage(deep=True, index=False) / 1e6})
+    report = report.sort_values(by="MB", ascending=False)
+    print(f"{name}: {len(df)} rows, {report['MB'].sum():.1f} MB")
+    print(report.head(10))
+    return report
+
+
 def filter_education(education_registration, vars_education, type_ed="BO basisonderwijs"):
     """
     Filters education registration data for a specific type of education and calculates additional columns.
@@ -184,7 +353,377 @@ def project_network(path, path_save_to, columns_school, year_var="year"):
                 fout, sep="\t", index=None, header=False, quoting=csv.QUOTE_NONE, escapechar=" "
             )
 
-def read_rivm(only_positives=True):
+def _pair_chunks(n, max_pairs):
+    """
+    Yields all pairs (i, j), i < j, of `n` students in the order of `combinations`, in chunks of about `max_pairs` pairs.
+
+    A chunk always contains all pairs of its first students `i`, so it can exceed `max_pairs` by up to `n - 1` pairs.
+    """
+    # Number of pairs starting at every student and first student of every chunk
+    n_pairs = np.arange(n - 1, 0, -1)
+    starts = np.cumsum(n_pairs) - n_pairs
+    bounds = np.unique(np.r_[np.searchsorted(starts, np.arange(0, n_pairs.sum(), max(max_pairs, 1)), "right") - 1, n - 1])
+
+    for i0, i1 in zip(bounds[:-1], bounds[1:]):
+        i = np.repeat(np.arange(i0, i1), n_pairs[i0:i1])
+        j = i + 1 + np.arange(len(i)) - np.repeat(starts[i0:i1] - starts[i0], n_pairs[i0:i1])
+        yield i, j
+
+
+# Bytes of memory of `project_network`, measured with tracemalloc on synthetic files (IDs of 16, 4 and 10 characters): 
+# ~64 bytes per cell of the dense frame created by `.apply(pd.Series)` (groups x pairs of the largest group of the 
+# year) and up to ~400 bytes per pair (pair tuples and joined rows)
+MEMORY_PER_CELL = 64
+MEMORY_PER_PAIR = 400
+
+
+def projection_peak_memory(plan, year_var, memory_per_cell=MEMORY_PER_CELL, memory_per_pair=MEMORY_PER_PAIR):
+    """
+    Estimates the peak memory of `project_network` for every year of a plan.
+
+    `project_network` unstacks the pairs with `.apply(pd.Series)`, which creates a dense frame with one 
+    row per group and one column per pair of the largest group, so a few huge groups dominate the peak.
+
+    Args:
+        plan (pd.DataFrame): Plan created with `plan_projection`.
+        year_var (str): The column name representing the year.
+        memory_per_cell (int, optional): Bytes per cell of the dense frame. Defaults to `MEMORY_PER_CELL`.
+        memory_per_pair (int, optional): Bytes per pair. Defaults to `MEMORY_PER_PAIR`.
+
+    Returns:
+        pd.Series: Peak memory in bytes, indexed by year.
+    """
+    years = plan.groupby(year_var)["n_pairs"].agg(["size", "max", "sum"])
+    return years["size"] * years["max"] * memory_per_cell + years["sum"] * memory_per_pair
+
+
+def plan_projection(path, columns_school, year_var="year", max_pairs_group=10_000_000,
+                    memory_per_cell=MEMORY_PER_CELL, memory_per_pair=MEMORY_PER_PAIR):
+    """
+    Predicts the number of pairs, the output size and the peak memory of projecting a network, without creating any pair.
+
+    This function reads only the group keys of the input file, counts the students of every group 
+    and calculates the exact number of pairs per group and year. Groups with more than `max_pairs_group` 
+    pairs are flagged and split into chunks, to be used as `max_pairs_chunk` in `project_network_sharded`.
+
+    Args:
+        path (str): Path to the input CSV file containing student and school data.
+        columns_school (list): List of columns that define the grouping for school attributes.
+        year_var (str, optional): The column name representing the year. Defaults to "year".
+        max_pairs_group (int, optional): Maximum number of pairs of a group created at once. Defaults to 10^7.
+        memory_per_cell (int, optional): Bytes per cell of the dense frame of `project_network` 
+                                         (see `projection_peak_memory`). Defaults to `MEMORY_PER_CELL`.
+        memory_per_pair (int, optional): Bytes of memory per pair while projecting. Defaults to `MEMORY_PER_PAIR`.
+
+    Returns:
+        pd.DataFrame: One row per group with the school columns, `n_students`, `n_pairs`, `output_bytes` 
+                      (size of the rows in the output file), `oversized` and `n_chunks`, largest groups first.
+
+    Notes:
+        - The size of the student IDs is estimated from the first 10,000 rows of the file.
+        - `project_network` keeps all pairs of a year in memory, and a dense frame of groups times the 
+          pairs of the largest group (see `projection_peak_memory`). `project_network_sharded` keeps one 
+          chunk in memory at a time.
+
+    Example:
+        >>> plan = plan_projection("vo_2020.tsv", ["BRIN_crypt", "VOBRINVEST", "VOLEERJAAR", "OPLNR"], "VOLEERJAAR")
+    """
+    print(f"Planning file {path}")
+    columns_ids = ["ONDERWIJSNR_crypt", "RINPERSOONS", "RINPERSOON"]
+
+    # Read only the group keys
+    keys = pd.read_csv(path, sep="\t", keep_default_na=False, dtype=str, usecols=list(dict.fromkeys(columns_school + [year_var])))
+    invalid = keys[year_var].str.contains("n.v.t.", regex=False) | (keys[year_var].str.strip() == "0")
+    keys = keys.loc[~invalid]
+
+    # Average size of the student IDs (3 columns and tabs), from a sample
+    sample = pd.read_csv(path, sep="\t", keep_default_na=False, dtype=str, usecols=columns_ids, nrows=10000)
+    bytes_ids = sum(sample[col].str.len().mean() for col in columns_ids) + len(columns_ids)
+
+    # Exact number of pairs per group
+    plan = keys.groupby(columns_school).size().rename("n_students").reset_index()
+    plan["n_pairs"] = plan["n_students"].astype(np.int64) * (plan["n_students"] - 1) // 2
+    bytes_key = sum(plan[col].str.len() + 1 for col in columns_school)
+    plan["output_bytes"] = (plan["n_pairs"] * (bytes_key + 2 * bytes_ids)).round().astype(np.int64)
+
+    # Flag the largest groups and split them in chunks
+    plan["oversized"] = plan["n_pairs"] > max_pairs_group
+    plan["n_chunks"] = np.maximum(1, np.ceil(plan["n_pairs"] / max_pairs_group)).astype(int)
+    plan = plan.sort_values(by="n_pairs", ascending=False, ignore_index=True)
+
+    # Summary per year
+    peak = projection_peak_memory(plan, year_var, memory_per_cell, memory_per_pair)
+    for year, plan_year in plan.groupby(year_var):
+        print(f"{year}: {plan_year['n_pairs'].sum():,} pairs in {len(plan_year):,} groups, "
+              f"output {plan_year['output_bytes'].sum() / 1e9:.1f} GB, "
+              f"peak memory project_network {peak[year] / 1e9:.1f} GB")
+    print(f"Largest group: {plan['n_students'].iloc[0]:,} students, {plan['n_pairs'].iloc[0]:,} pairs" if len(plan) else "No groups")
+    if plan["oversized"].any():
+        print(f"{plan['oversized'].sum()} groups with more than {max_pairs_group:,} pairs "
+              f"({plan.loc[plan['oversized'], 'n_pairs'].sum() / plan['n_pairs'].sum():.0%} of all pairs), "
+              f"project them in {plan['n_chunks'].max()} chunks or less with max_pairs_chunk={max_pairs_group:,}")
+
+    return plan
+
+
+def choose_projection(plan, year_var, memory_budget, max_pairs_chunk=10_000_000,
+                      memory_per_cell=MEMORY_PER_CELL, memory_per_pair=MEMORY_PER_PAIR):
+    """
+    Chooses how to project a network from its plan, so that the projection does not run out of memory.
+
+    Args:
+        plan (pd.DataFrame): Plan created with `plan_projection`.
+        year_var (str): The column name representing the year.
+        memory_budget (float): Bytes of memory available for the projection.
+        max_pairs_chunk (int, optional): Maximum number of pairs created at once by `project_network_sharded`. 
+                                         Defaults to 10^7.
+        memory_per_cell (int, optional): Bytes per cell of the dense frame of `project_network`. 
+                                         Defaults to `MEMORY_PER_CELL` (see `projection_peak_memory`).
+        memory_per_pair (int, optional): Bytes of memory per pair while projecting. Defaults to `MEMORY_PER_PAIR`.
+
+    Returns:
+        str: "full" if `project_network` fits in the budget and no group is oversized, or "chunked" 
+             if only `project_network_sharded` (one chunk in memory) fits.
+
+    Raises:
+        MemoryError: If not even one chunk fits in the budget (lower `max_pairs_chunk`).
+    """
+    peak_full = projection_peak_memory(plan, year_var, memory_per_cell, memory_per_pair).max() if len(plan) else 0
+    peak_chunk = min(plan["n_pairs"].max() if len(plan) else 0, max_pairs_chunk) * memory_per_pair
+    if (peak_full <= memory_budget) and not plan["oversized"].any():
+        return "full"
+    print(f"Peak memory of project_network ({peak_full / 1e9:.1f} GB, budget {memory_budget / 1e9:.1f} GB) "
+          f"or {plan['oversized'].sum()} oversized groups, using the chunked projection")
+    if peak_chunk <= memory_budget:
+        return "chunked"
+    raise MemoryError(f"Peak memory of a chunk ({peak_chunk / 1e9:.1f} GB) exceeds the budget ({memory_budget / 1e9:.1f} GB), "
+                      f"lower max_pairs_chunk")
+
+
+def project_network_sharded(path, path_store, year, columns_school, year_var="year", n_shards=64, max_pairs_chunk=10_000_000):
+    """
+    Projects the network like `project_network`, but stores the pairs sharded by year and BRIN with an offset index.
+
+    Every school (first column of `columns_school`) is assigned to one of `n_shards` shard files, 
+    and the pairs of every group are written contiguously. An index file records, for every group, 
+    the shard and the byte and row ranges of its pairs, so a single group (or school) can be read 
+    without parsing the rest of the file (see `read_projected_groups`).
+
+    Args:
+        path (str): Path to the input CSV file containing student and school data.
+        path_store (str): Folder of the sharded store. The files are saved in `{path_store}/{year}`.
+        year (int): Year of the input file (e.g. 2020 for `bo_2020.tsv`).
+        columns_school (list): List of columns that define the grouping for school attributes. 
+                               The first column must be the BRIN.
+        year_var (str, optional): The column name representing the year. Defaults to "year".
+        n_shards (int, optional): Number of shards per year. Defaults to 64.
+        max_pairs_chunk (int, optional): Maximum number of pairs created in memory at once. Larger groups 
+                                         are written in several chunks (see `plan_projection`). Defaults to 10^7.
+
+    Returns:
+        pd.DataFrame: The offset index, also saved to `{path_store}/{year}/index.tsv`.
+
+    Notes:
+        - Every shard is a tab-separated file with a header and the same columns as the output of 
+          `project_network`, so all shards of a year can be scanned in parallel, e.g. with 
+          `dask.dataframe.read_csv(f"{path_store}/{year}/shard_*.tsv", sep="\\t", dtype=str)`.
+        - The BRIN is assigned to a shard with CRC32, the assignment is the same in every year.
+        - The pairs of every group are in the same order as in `project_network`.
+
+    Example:
+        >>> project_network_sharded("bo_2020.tsv", "projected_sharded", 2020, ["WPOBRIN_crypt", "WPOBRINVEST"])
+    """
+    print(f"Analyzing file {path}")
+    path_year = f"{path_store}/{year}"
+    os.makedirs(path_year, exist_ok=True)
+
+    # Read the input data
+    data_full = pd.read_csv(path, sep="\t", keep_default_na=False, dtype=str)
+
+    # Skip invalid or placeholder years
+    invalid = data_full[year_var].str.contains("n.v.t.", regex=False) | (data_full[year_var].str.strip() == "0")
+    data_full = data_full.loc[~invalid]
+
+    # Columns of the output and tab-separated IDs of the students
+    columns = columns_school + [
+        "ONDERWIJSNR_crypt1",
+        "RINPERSOONS1",
+        "RINPERSOON1",
+        "ONDERWIJSNR_crypt2",
+        "RINPERSOONS2",
+        "RINPERSOON2"
+    ]
+    data_full["ids"] = data_full["ONDERWIJSNR_crypt"] + "\t" + data_full["RINPERSOONS"] + "\t" + data_full["RINPERSOON"]
+
+    # Assign every school to a shard
+    brins = data_full[columns_school[0]].unique()
+    brin2shard = {brin: zlib.crc32(brin.encode()) % n_shards for brin in brins}
+    data_full["shard"] = data_full[columns_school[0]].map(brin2shard)
+
+    st = time.time()
+    index = []
+    for shard, data_shard in data_full.groupby("shard"):
+        path_shard = f"{path_year}/shard_{shard:03d}.tsv"
+        row = 0
+
+        with open(path_shard, "wb+") as fout:
+            fout.write(("\t".join(columns) + "\n").encode())
+
+            for group, data in data_shard.groupby(columns_school, sort=True):
+                if len(data) < 2:
+                    continue
+                ids = data["ids"].to_numpy(dtype=object)
+                prefix = "\t".join(group) + "\t"
+                offset, nbytes, nrows = fout.tell(), 0, 0
+
+                # Create all pairs of students within the group, in the same order as `combinations`
+                for i, j in _pair_chunks(len(data), max_pairs_chunk):
+                    text = "".join(prefix + ids[i] + "\t" + ids[j] + "\n").encode()
+                    fout.write(text)
+                    nbytes += len(text)
+                    nrows += len(i)
+
+                # Keep the location of the pairs in the shard
+                index.append(list(group) + [shard, offset, nbytes, row, nrows])
+                row += nrows
+
+    index = pd.DataFrame(index, columns=columns_school + ["shard", "offset", "nbytes", "row", "nrows"])
+    index.to_csv(f"{path_year}/index.tsv", sep="\t", index=None)
+    print(f"{index['nrows'].sum()} pairs for {len(index)} groups written in {time.time() - st: 2.0f} seconds")
+
+    return index
+
+
+def read_projected_index(path_store, year):
+    """
+    Reads the offset index of a sharded projected network (see `project_network_sharded`).
+
+    Args:
+        path_store (str): Folder of the sharded store.
+        year (int): Year to read.
+
+    Returns:
+        pd.DataFrame: One row per group with the school columns, `shard`, `offset`, `nbytes`, `row` and `nrows`.
+    """
+    index = pd.read_csv(f"{path_store}/{year}/index.tsv", sep="\t", keep_default_na=False, dtype=str)
+    for col in ["shard", "offset", "nbytes", "row", "nrows"]:
+        index[col] = index[col].astype(np.int64)
+    return index
+
+
+def read_projected_groups(path_store, year, index=None, **key):
+    """
+    Reads the pairs of the groups matching a key from a sharded projected network, without parsing the rest of the shards.
+
+    Args:
+        path_store (str): Folder of the sharded store.
+        year (int): Year to read.
+        index (pd.DataFrame, optional): Offset index (see `read_projected_index`). Read from disk if None.
+        **key: Values of the school columns to select, e.g. `BRIN_crypt="..."`, `VOBRINVEST="01"`. 
+               Columns not given are not filtered, so passing only the BRIN returns all pairs of a school.
+
+    Returns:
+        pd.DataFrame: The pairs of the selected groups, with the same columns as the output of `project_network`.
+
+    Example:
+        >>> pairs = read_projected_groups("projected_sharded", 2020, BRIN_crypt="...", VOLEERJAAR="leerjaar 1")
+    """
+    if index is None:
+        index = read_projected_index(path_store, year)
+
+    # Select the groups matching the key
+    selected = index
+    for col, value in key.items():
+        selected = selected.loc[selected[col] == value]
+
+    pairs = []
+    for shard, groups in selected.groupby("shard"):
+        path_shard = f"{path_store}/{year}/shard_{shard:03d}.tsv"
+        with open(path_shard, "rb") as f:
+            columns = f.readline().decode().rstrip("\n").split("\t")
+
+            # Read only the byte ranges of the selected groups
+            for offset, nbytes in groups[["offset", "nbytes"]].values:
+                f.seek(offset)
+                pairs.append(pd.read_csv(io.BytesIO(f.read(nbytes)), sep="\t", header=None, names=columns,
+                                         keep_default_na=False, dtype=str))
+
+    if len(pairs) == 0:
+        return pd.DataFrame(columns=list(index.columns[:-5]) + [
+            "ONDERWIJSNR_crypt1", "RINPERSOONS1", "RINPERSOON1", "ONDERWIJSNR_crypt2", "RINPERSOONS2", "RINPERSOON2"])
+    return pd.concat(pairs, ignore_index=True)
+
+
+def project_network_weighted(files, path_save_to, chunk_size=100000):
+    """
+    Projects the student-group networks of several years into one weighted student-student network.
+
+    This function builds the sparse incidence matrix B between students and groups (one group per 
+    file and combination of school attributes) across all files, and computes B·Bᵀ in blocks of rows. 
+    The weight of every pair is the number of groups (years in the same class) the two students shared.
+
+    Args:
+        files (dict): Maps the path of every bipartite file (e.g. `bo_2015.tsv`) to a tuple 
+                      (`columns_school`, `year_var`), as used in `project_network`.
+        path_save_to (str): Path to save the output file with the weighted network.
+        chunk_size (int, optional): Number of students (rows of B) multiplied at once. Defaults to 100000.
+
+    Returns:
+        None: The function writes the output directly to the specified file.
+
+    Notes:
+        - Students are identified by `RINPERSOON` (stripped), rows without `RINPERSOON` are dropped.
+        - Rows with invalid or placeholder years are skipped, as in `project_network`.
+        - The output is tab-separated with columns `RINPERSOON1`, `RINPERSOON2` and `weight`, and 
+          contains every pair once (`RINPERSOON1` < `RINPERSOON2`).
+        - The peak memory is set by `chunk_size` times the number of classmates per student.
+
+    Example:
+        >>> project_network_weighted({"bo_2019.tsv": (["WPOBRIN_crypt", "WPOLEERJAAR"], "WPOLEERJAAR")}, "weighted.tsv")
+    """
+    persons_files, groups_files = [], []
+    n_groups = 0
+    for path, (columns_school, year_var) in files.items():
+        print(f"Reading file {path}")
+        data = pd.read_csv(path, sep="\t", keep_default_na=False, dtype=str, 
+                           usecols=list(dict.fromkeys(columns_school + [year_var, "RINPERSOON"])))
+        data["RINPERSOON"] = data["RINPERSOON"].str.strip()
+
+        # Skip invalid or placeholder years and students without RINPERSOON
+        invalid = data[year_var].str.contains("n.v.t.", regex=False) | (data[year_var].str.strip() == "0")
+        data = data.loc[~invalid & (data["RINPERSOON"] != "")]
+
+        # Code the groups of the file as integers, after the groups of the previous files
+        codes, group_index = pd.MultiIndex.from_frame(data[columns_school]).factorize()
+        persons_files.append(data["RINPERSOON"].values)
+        groups_files.append(codes + n_groups)
+        n_groups += len(group_index)
+
+    # Incidence matrix between students and groups
+    persons = intern_persons(*persons_files)
+    row = np.concatenate([persons.get_indexer(np.asarray(p, dtype=str)) for p in persons_files])
+    col = np.concatenate(groups_files)
+    incidence = sparse.csr_matrix((np.ones(len(row), dtype=np.int32), (row, col)), shape=(len(persons), n_groups))
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    print(f"{len(persons)} students in {n_groups} groups")
+
+    incidence_t = incidence.T.tocsr()
+    with open(path_save_to, "w+") as fout:
+        fout.write("RINPERSOON1\tRINPERSOON2\tweight\n")
+
+        for start in range(0, len(persons), chunk_size):
+            st = time.time()
+
+            # Shared groups between the students of the block and all students, keeping each pair once
+            block = sparse.triu(incidence[start:start + chunk_size] @ incidence_t, k=start + 1).tocoo()
+            pd.DataFrame({"RINPERSOON1": persons.values[block.row + start],
+                          "RINPERSOON2": persons.values[block.col],
+                          "weight": block.data}).to_csv(fout, sep="\t", index=None, header=False)
+            print(f"{block.nnz} pairs for students {start}-{start + chunk_size} in {time.time() - st: 2.0f} seconds")
+
+
+def read_rivm(only_positives=True, path_rivm="G:\\Maatwerk\\CORONIT\\CoronIT_GGD_testdata_20210921.sav"):
     """
     Reads and processes RIVM test data, returning a dictionary of days since a reference date for each person.
 
@@ -194,6 +733,7 @@ def read_rivm(only_positives=True):
 
     Args:
         only_positives (bool, optional): If True, only includes positive test results. Defaults to True.
+        path_rivm (str, optional): Path to the RIVM extract. Defaults to the 2021-09-21 snapshot.
 
     Returns:
         dict: A dictionary where keys are personal identifiers (`RINPERSOON`) and values are days 
@@ -206,8 +746,6 @@ def read_rivm(only_positives=True):
     Example:
         >>> rivm_dict = read_rivm(only_positives=True)
     """
-    path_rivm = "G:\\Maatwerk\\CORONIT\\CoronIT_GGD_testdata_20210921.sav"
-
     # Load RIVM data from the specified SPSS file
     rivm = pd.read_spss(path_rivm)
 
@@ -242,6 +780,522 @@ def read_rivm(only_positives=True):
     return rivm.set_index("RINPERSOON")["days_from_start"].to_dict()
 
 
+def update_infection_store(path_store, path_rivm, only_positives=True):
+    """
+    Appends the tests of a new RIVM extract that are newer than the last ingested test date to the infection store.
+
+    The infection store is an append-only folder with two files: `infections.tsv` (one row per 
+    person and test day, as in `read_rivm`) and `last_date.txt` (the last `DatumMonsterafname` 
+    processed). Only rows with a `DatumMonsterafname` after the stored date are kept, so each 
+    extract adds only the weeks that were not seen before.
+
+    Args:
+        path_store (str): Folder of the infection store. Created if it does not exist.
+        path_rivm (str): Path to the (newer) RIVM extract in SPSS format.
+        only_positives (bool, optional): If True, only stores positive test results. Defaults to True.
+
+    Returns:
+        dict: The first new test of every person, mapping personal identifiers (`RINPERSOON`) to days 
+              from January 1, 2020. Pass it to `update_coinfection_counts` to update the co-infection counts.
+
+    Notes:
+        - The last processed date is computed before filtering on `Testuitslag`, negative tests also 
+          move the date forward.
+        - Tests reported late for a day that was already processed are not ingested.
+        - All tests are stored, but only the first infection of a person is used (see `read_infection_store`).
+
+    Example:
+        >>> new_infections = update_infection_store("infection_store", "CoronIT_GGD_testdata_20211005.sav")
+    """
+    os.makedirs(path_store, exist_ok=True)
+    path_tests = f"{path_store}/infections.tsv"
+    path_last_date = f"{path_store}/last_date.txt"
+
+    # Read the last processed test date (None if the store is empty)
+    last_date = None
+    if os.path.exists(path_last_date):
+        with open(path_last_date) as f:
+            last_date = pd.to_datetime(f.read().strip())
+
+    # Load only the columns needed from the RIVM extract
+    rivm = pd.read_spss(path_rivm, usecols=["RINPERSOON", "DatumMonsterafname", "Testuitslag"])
+    rivm = rivm.loc[rivm["RINPERSOON"] != '""']
+    rivm["date"] = pd.to_datetime(rivm["DatumMonsterafname"])
+
+    # Keep only the tests after the last processed date
+    if last_date is not None:
+        rivm = rivm.loc[rivm["date"] > last_date]
+    print(f"{len(rivm)} new tests after {last_date}")
+    if len(rivm) == 0:
+        return {}
+    new_last_date = rivm["date"].max()
+
+    # Convert "Testuitslag" to a binary column and filter positives, as in `read_rivm`
+    rivm["Testuitslag"] = rivm["Testuitslag"] != "NEGATIEF"
+    if only_positives:
+        rivm = rivm.loc[rivm["Testuitslag"]]
+
+    # Calculate the number of days from the reference date (January 1, 2020)
+    rivm["days_from_start"] = (rivm["date"] - pd.to_datetime("2020-01-01")).dt.days
+    rivm = rivm.sort_values(by="date")[["RINPERSOON", "days_from_start"]].drop_duplicates()
+
+    # Append the new rows and move the last processed date forward
+    rivm.to_csv(path_tests, sep="\t", index=None, mode="a", header=not os.path.exists(path_tests))
+    with open(path_last_date, "w+") as f:
+        f.write(new_last_date.strftime("%Y-%m-%d"))
+
+    return rivm.drop_duplicates(subset="RINPERSOON").set_index("RINPERSOON")["days_from_start"].to_dict()
+
+
+def read_infection_store(path_store):
+    """
+    Reads the infection store, returning the same dictionary as `read_rivm`.
+
+    Args:
+        path_store (str): Folder of the infection store (see `update_infection_store`).
+
+    Returns:
+        dict: A dictionary where keys are personal identifiers (`RINPERSOON`) and values are days 
+              from January 1, 2020. If a person has several positive tests, the first one is kept, so 
+              later reinfections do not change the co-infections already counted.
+    """
+    rivm = pd.read_csv(f"{path_store}/infections.tsv", sep="\t", dtype={"RINPERSOON": str})
+    rivm = rivm.sort_values(by="days_from_start", kind="stable").drop_duplicates(subset="RINPERSOON")
+    return rivm.set_index("RINPERSOON")["days_from_start"].to_dict()
+
+
+def index_pairs_by_person(pairs):
+    """
+    Creates an index from person to the rows of a pair table where the person appears.
+
+    Args:
+        pairs (pd.DataFrame): A DataFrame with columns `RINPERSOON1` and `RINPERSOON2`.
+
+    Returns:
+        tuple: Two NumPy arrays (`persons`, `rows`), sorted by person. The rows where person `p` 
+               appears are `rows[np.searchsorted(persons, p, "left"):np.searchsorted(persons, p, "right")]`.
+    """
+    persons = np.concatenate([pairs["RINPERSOON1"].values, pairs["RINPERSOON2"].values]).astype(str)
+    rows = np.tile(np.arange(len(pairs)), 2)
+
+    # Sort by person to look up the rows with a binary search
+    order = np.argsort(persons, kind="stable")
+    return persons[order], rows[order]
+
+
+def coinfection_periods(pairs, rivm, threshold=14, period_days=7):
+    """
+    Finds the co-infected pairs and the period when they were co-infected.
+
+    Args:
+        pairs (pd.DataFrame): A DataFrame with columns `Group`, `RINPERSOON1` and `RINPERSOON2`.
+        rivm (dict): Dictionary mapping persons to days from January 1, 2020 (see `read_rivm`).
+        threshold (int, optional): Maximum difference (exclusive) in days between infections. Defaults to 14.
+        period_days (int, optional): Length of a period in days. Defaults to 7 (weeks).
+
+    Returns:
+        pd.DataFrame: One row per co-infected pair, with columns `Group` and `period` (the period of 
+                      the first infection of the pair, counted from January 1, 2020).
+    """
+    date_infection_1 = pairs["RINPERSOON1"].map(rivm)
+    date_infection_2 = pairs["RINPERSOON2"].map(rivm)
+    co_infected = ((date_infection_1 - date_infection_2).abs() < threshold).values
+
+    period = np.fmin(date_infection_1, date_infection_2)[co_infected] // period_days
+    return pd.DataFrame({"Group": pairs["Group"].values[co_infected], "period": period.astype(int).values})
+
+
+def count_coinfections(pairs, rivm, threshold=14, period_days=7):
+    """
+    Counts the co-infected pairs per group and period.
+
+    Args:
+        pairs (pd.DataFrame): A DataFrame with columns `Group`, `RINPERSOON1` and `RINPERSOON2`.
+        rivm (dict): Dictionary mapping persons to days from January 1, 2020 (see `read_rivm`).
+        threshold (int, optional): Maximum difference (exclusive) in days between infections. Defaults to 14.
+        period_days (int, optional): Length of a period in days. Defaults to 7 (weeks).
+
+    Returns:
+        pd.Series: Number of co-infected pairs (`N_inf`), indexed by (`Group`, `period`).
+    """
+    periods = coinfection_periods(pairs, rivm, threshold, period_days)
+    return periods.groupby(["Group", "period"]).size().rename("N_inf")
+
+
+def update_coinfection_counts(counts, pairs, pair_index, rivm, new_infections, threshold=14, period_days=7):
+    """
+    Updates the co-infection counts with new infections, looking only at the pairs of the newly infected persons.
+
+    Only the first infection of a person is used: persons already in `rivm` (reinfections) are ignored, 
+    so counted co-infections are never removed. A pair containing a newly infected person was not 
+    co-infected before, so its co-infection is only added, in the period of the earlier infection of 
+    the pair: a new infection up to `threshold` - 1 days after the partner's infection adds to a past 
+    period. The pairs are found in `pair_index`, so the cost is proportional to the number of new 
+    infections (times the number of pairs per person), not to the size of the pair table.
+
+    Args:
+        counts (pd.Series): Co-infection counts indexed by (`Group`, `period`) (see `count_coinfections`).
+        pairs (pd.DataFrame): A DataFrame with columns `Group`, `RINPERSOON1` and `RINPERSOON2`.
+        pair_index (tuple): Index created with `index_pairs_by_person(pairs)`.
+        rivm (dict): Dictionary mapping persons to days from January 1, 2020 before the update. 
+                     The persons of `new_infections` not yet infected are added in place.
+        new_infections (dict): New rows of the infection store (see `update_infection_store`).
+        threshold (int, optional): Maximum difference (exclusive) in days between infections. Defaults to 14.
+        period_days (int, optional): Length of a period in days. Defaults to 7 (weeks).
+
+    Returns:
+        pd.Series: Updated co-infection counts indexed by (`Group`, `period`).
+
+    Notes:
+        - Only this summary is updated incrementally. `stats_full.tsv`, `stats.xlsx` and 
+          `aggregate_store.pkl` (subsets, distances and days between infections) are only updated 
+          by re-running 3_analysis.py.
+
+    Example:
+        >>> counts = update_coinfection_counts(counts, pairs, pair_index, rivm, new_infections)
+    """
+    persons, rows = pair_index
+    # Keep the first infection of every person (reinfections are ignored)
+    new_infections = {person: day for person, day in new_infections.items() if person not in rivm}
+    new_persons = np.array(list(new_infections), dtype=str)
+
+    # Find the rows of all pairs containing a newly infected person
+    left = np.searchsorted(persons, new_persons, "left")
+    n_rows = np.searchsorted(persons, new_persons, "right") - left
+    positions = np.repeat(left - np.cumsum(n_rows) + n_rows, n_rows) + np.arange(n_rows.sum())
+    affected = pairs.iloc[np.unique(rows[positions])]
+    print(f"{len(new_persons)} new infections affecting {len(affected)} pairs")
+
+    # The affected pairs were not co-infected before (one person was not infected), add their co-infections
+    for person, day in new_infections.items():
+        rivm.setdefault(person, day)
+    new = coinfection_periods(affected, rivm, threshold, period_days).groupby(["Group", "period"]).size()
+
+    counts = counts.add(new, fill_value=0).astype(int)
+    return counts.loc[counts > 0].rename("N_inf")
+
+
+def intern_persons(*columns):
+    """
+    Creates a sorted index of all person codes appearing in one or more columns.
+
+    Args:
+        *columns (pd.Series or np.ndarray): Columns with person codes (`RINPERSOON`).
+
+    Returns:
+        pd.Index: Sorted unique person codes. The position of a person in the index is its row/column 
+                  in the sparse matrices created with `pairs_to_csr` and `group_incidence`.
+    """
+    return pd.Index(np.unique(np.concatenate([np.asarray(col, dtype=str) for col in columns])))
+
+
+def pairs_to_csr(persons, src, dst, symmetric=True, binary=True):
+    """
+    Creates a sparse adjacency matrix (CSR) from a list of pairs.
+
+    Args:
+        persons (pd.Index): Person codes (see `intern_persons`).
+        src (pd.Series or np.ndarray): Person codes of the first person of every pair.
+        dst (pd.Series or np.ndarray): Person codes of the second person of every pair.
+        symmetric (bool, optional): If True, every pair is added in both directions. Defaults to True.
+        binary (bool, optional): If True, duplicated pairs count once. Defaults to True.
+
+    Returns:
+        scipy.sparse.csr_matrix: Square matrix of size `len(persons)`, with the number of links between persons.
+
+    Notes:
+        - Pairs with a person not in `persons` are dropped.
+    """
+    row = persons.get_indexer(np.asarray(src, dtype=str))
+    col = persons.get_indexer(np.asarray(dst, dtype=str))
+    keep = (row >= 0) & (col >= 0)
+    row, col = row[keep], col[keep]
+
+    if symmetric:
+        row, col = np.concatenate([row, col]), np.concatenate([col, row])
+
+    adjacency = sparse.csr_matrix((np.ones(len(row), dtype=np.int32), (row, col)), shape=(len(persons), len(persons)))
+    adjacency.sum_duplicates()
+    if binary:
+        adjacency.data[:] = 1
+    return adjacency
+
+
+def group_incidence(persons, person, groups):
+    """
+    Creates the sparse incidence matrix between persons and groups (e.g. classes or schools).
+
+    Args:
+        persons (pd.Index): Person codes (see `intern_persons`).
+        person (pd.Series or np.ndarray): Person code of every membership.
+        groups (pd.DataFrame): Columns defining the group of every membership, e.g. 
+                               `["BRIN_crypt", "BRINVEST", "OPLNR"]`.
+
+    Returns:
+        tuple: The incidence matrix (`scipy.sparse.csr_matrix`, persons x groups) and a `pd.MultiIndex` 
+               (or `pd.Index`) with the groups of the columns.
+    """
+    # Code every group as an integer (column of the matrix)
+    if groups.shape[1] > 1:
+        codes, group_index = pd.MultiIndex.from_frame(groups).factorize()
+    else:
+        codes, group_index = pd.factorize(groups.iloc[:, 0])
+    row = persons.get_indexer(np.asarray(person, dtype=str))
+    keep = (row >= 0) & (codes >= 0)
+
+    incidence = sparse.csr_matrix((np.ones(keep.sum(), dtype=np.int32), (row[keep], codes[keep])),
+                                  shape=(len(persons), len(group_index)))
+    incidence.sum_duplicates()
+    incidence.data[:] = 1
+    return incidence, group_index
+
+
+def count_paths(*layers, exclude=None):
+    """
+    Counts the paths between persons that go through a sequence of network layers, using sparse products.
+
+    For example, `count_paths(siblings, classmates)` counts, for every pair (i, j), the number of 
+    siblings of i that are classmates of j ("classmates of my sibling").
+
+    Args:
+        *layers (scipy.sparse matrix): Adjacency matrices (see `pairs_to_csr`), in the order of the path.
+        exclude (scipy.sparse matrix, optional): Pairs to remove from the result, e.g. persons that 
+                                                 are already directly connected. Defaults to None.
+
+    Returns:
+        scipy.sparse.csr_matrix: Number of paths between every pair of persons, without self-loops.
+    """
+    paths = layers[0].tocsr()
+    for layer in layers[1:]:
+        paths = paths @ layer
+
+    # Remove paths from a person to themself and the excluded pairs
+    paths.setdiag(0)
+    if exclude is not None:
+        paths = paths - paths.multiply(exclude > 0)
+    paths.eliminate_zeros()
+    return paths.tocsr()
+
+
+def paths_to_pairs(paths, persons):
+    """
+    Converts a sparse matrix of paths into a pair table.
+
+    Args:
+        paths (scipy.sparse matrix): Number of paths between persons (see `count_paths`).
+        persons (pd.Index): Person codes (see `intern_persons`).
+
+    Returns:
+        pd.DataFrame: One row per connected pair, with columns `RINPERSOON1`, `RINPERSOON2` and `n_paths`.
+    """
+    paths = paths.tocoo()
+    return pd.DataFrame({"RINPERSOON1": persons.values[paths.row],
+                         "RINPERSOON2": persons.values[paths.col],
+                         "n_paths": paths.data})
+
+
+def distance_bins(distance, thresholds=(-1, 0, 300, 1000, 3000, 10000, 30000, 300000)):
+    """
+    Assigns every distance to the distance ranges used in `save_calc_prop` (e.g. "300-1000").
+
+    Args:
+        distance (pd.Series): Distances in meters.
+        thresholds (tuple, optional): Limits of the ranges. Defaults to the ranges of the paper.
+
+    Returns:
+        pd.Series: Categorical series with the range (th_p, threshold] of every distance, labelled 
+                   as "th_p-threshold". Distances outside all ranges are NaN.
+    """
+    labels = [f"{th_p}-{threshold}" for th_p, threshold in zip(thresholds[:-1], thresholds[1:])]
+    return pd.cut(distance, bins=list(thresholds), labels=labels)
+
+
+def aggregate_binomial(df, columns, outcome="co_infected"):
+    """
+    Collapses pairs with the same values in `columns` into aggregated binomial rows.
+
+    Args:
+        df (pd.DataFrame): A DataFrame with one row per pair and a binary column `outcome`.
+        columns (list): Columns defining the cells (e.g. group, school, gemeente, distance range).
+        outcome (str, optional): Binary outcome column. Defaults to "co_infected".
+
+    Returns:
+        pd.DataFrame: One row per cell, with the columns in `columns`, `N` (number of pairs) and 
+                      `N_inf` (number of pairs with the outcome).
+    """
+    cells = df.groupby(columns, observed=True, dropna=False)[outcome].agg(N="size", N_inf="sum")
+    cells["N_inf"] = cells["N_inf"].astype(int)
+    return cells.reset_index()
+
+
+def _pirls(A, n_fixed, y, n, start, maxiter=100, tol=1e-10):
+    """
+    Finds the conditional mode of the fixed and (spherical) random effects of a binomial GLMM with penalized IRLS.
+
+    Args:
+        A (scipy.sparse matrix): Design matrix [X, ZΛ].
+        n_fixed (int): Number of columns of X.
+        y (np.ndarray): Successes per row.
+        n (np.ndarray): Trials per row.
+        start (np.ndarray): Starting values of the coefficients.
+        maxiter (int, optional): Maximum number of Newton steps. Defaults to 100.
+        tol (float, optional): Relative tolerance on the penalized log-likelihood. Defaults to 1e-10.
+
+    Returns:
+        tuple: Coefficients at the mode, binomial log-likelihood, the penalized Hessian (sparse) and the weights.
+    """
+    penalty = np.r_[np.zeros(n_fixed), np.ones(A.shape[1] - n_fixed)]
+
+    def objective(coef):
+        eta = A @ coef
+        loglik = np.sum(y * eta - n * np.logaddexp(0, eta))
+        return loglik - 0.5 * np.sum(penalty * coef**2), loglik
+
+    coef = start
+    obj, loglik = objective(coef)
+    for _ in range(maxiter):
+        mu = expit(A @ coef)
+        weights = n * mu * (1 - mu)
+        hessian = (A.T @ sparse.diags(weights) @ A + sparse.diags(penalty)).tocsc()
+        step = splu(hessian).solve(A.T @ (y - n * mu) - penalty * coef)
+
+        # Newton step, halved until the penalized log-likelihood increases
+        t = 1.
+        while True:
+            new_obj, new_loglik = objective(coef + t * step)
+            if (new_obj >= obj) or (t < 1e-6):
+                break
+            t /= 2
+        coef = coef + t * step
+        converged = abs(new_obj - obj) < tol * (abs(obj) + 1)
+        obj, loglik = new_obj, new_loglik
+        if converged:
+            break
+
+    # Weights and Hessian at the mode
+    mu = expit(A @ coef)
+    weights = n * mu * (1 - mu)
+    hessian = (A.T @ sparse.diags(weights) @ A + sparse.diags(penalty)).tocsc()
+    return coef, loglik, hessian, weights
+
+
+def fit_binomial_glmm(cells, fixed, random, successes="N_inf", trials="N"):
+    """
+    Fits a logistic model with nested random intercepts to aggregated binomial rows (successes, trials).
+
+    Pairs with the same covariates and groups share the same likelihood contribution, so the model is 
+    fitted on the cells created with `aggregate_binomial` instead of one row per pair. The fit uses 
+    the Laplace approximation, with the fixed and random effects estimated jointly by penalized IRLS 
+    and the standard deviations of the random intercepts optimized with Nelder-Mead (as `glmer` with 
+    `nAGQ = 0`).
+
+    Args:
+        cells (pd.DataFrame): Aggregated binomial rows (see `aggregate_binomial`).
+        fixed (list): Fixed-effect columns. Non-numeric columns are coded as dummies, with the first 
+                      level (alphabetically) as reference, as in R.
+        random (list): Random intercepts, each one a list of columns. Nested terms are written as 
+                       the list of grouping columns, e.g. `[["gemcode"], ["gemcode", "school_id"]]` for 
+                       `(1 | gemcode) + (1 | gemcode:school_id)`.
+        successes (str, optional): Column with the number of successes. Defaults to "N_inf".
+        trials (str, optional): Column with the number of trials. Defaults to "N".
+
+    Returns:
+        dict: With keys
+            - `fixef`: pd.DataFrame with `Estimate`, `Std. Error`, `z value` and `Pr(>|z|)`.
+            - `vcov`: pd.DataFrame with the covariance matrix of the fixed effects.
+            - `ranef`: pd.DataFrame with `grpvar`, `term`, `grp`, `condval` and `condsd` (as `ranef` in lme4).
+            - `varcorr`: pd.DataFrame with `grpvar`, `vcov` and `sdcor` of the random intercepts.
+            - `stats`: pd.Series with the log-likelihood, AIC, BIC, number of observations and groups.
+
+    Notes:
+        - The binomial coefficients are not included in the log-likelihood, so it is the same as 
+          the log-likelihood of the model fitted on one row per pair.
+        - The number of observations used in the BIC is the number of pairs (sum of `trials`).
+
+    Example:
+        >>> cells = aggregate_binomial(pairs, ["Group", "gemcode", "school_id", "Distance"])
+        >>> model = fit_binomial_glmm(cells, ["Group", "Distance"], [["gemcode"], ["gemcode", "school_id"]])
+    """
+    y = cells[successes].to_numpy(dtype=float)
+    n = cells[trials].to_numpy(dtype=float)
+
+    # Fixed effects (with intercept)
+    X = pd.DataFrame({"(Intercept)": np.ones(len(cells))}, index=cells.index)
+    if len(fixed) > 0:
+        X = X.join(pd.get_dummies(cells[fixed], drop_first=True, prefix_sep="", dtype=float))
+    names_fixed = list(X.columns)
+    X = sparse.csr_matrix(X.to_numpy(dtype=float))
+
+    # Random intercepts, one block of columns per term
+    Z, term_of_col, ranef = [], [], []
+    for k, columns in enumerate(random):
+        grpvar = ":".join(columns)
+        codes, levels = pd.factorize(cells[columns].astype(str).agg(":".join, axis=1), sort=True)
+        Z.append(sparse.csr_matrix((np.ones(len(codes)), (np.arange(len(codes)), codes)), shape=(len(codes), len(levels))))
+        term_of_col.append(np.full(len(levels), k))
+        ranef.append(pd.DataFrame({"grpvar": grpvar, "term": "(Intercept)", "grp": levels}))
+    Z = sparse.hstack(Z).tocsr()
+    term_of_col = np.concatenate(term_of_col)
+    ranef = pd.concat(ranef, ignore_index=True)
+    n_fixed, n_random = X.shape[1], Z.shape[1]
+    print(f"{len(cells)} cells ({n.sum():.0f} pairs), {n_fixed} fixed effects, {n_random} random effects")
+
+    def design(sigma):
+        return sparse.hstack([X, Z @ sparse.diags(sigma[term_of_col])]).tocsc()
+
+    # Laplace approximation of the deviance, as a function of the standard deviations
+    start = [np.zeros(n_fixed + n_random)]
+    def deviance(theta):
+        coef, loglik, hessian, _ = _pirls(design(np.abs(theta)), n_fixed, y, n, start[0])
+        start[0] = coef
+        lu = splu(hessian[n_fixed:, n_fixed:].tocsc())
+        logdet = np.sum(np.log(np.abs(lu.U.diagonal())))
+        return -2 * loglik + np.sum(coef[n_fixed:]**2) + logdet
+
+    st = time.time()
+    opt = minimize(deviance, x0=np.ones(len(random)), method="Nelder-Mead", options={"xatol": 1e-4, "fatol": 1e-6})
+    sigma = np.abs(opt.x)
+    print(f"Fitted in {time.time() - st: 2.0f} seconds ({opt.nfev} evaluations)")
+
+    # Conditional modes and their covariance at the optimum
+    coef, loglik, hessian, _ = _pirls(design(sigma), n_fixed, y, n, start[0])
+    lu = splu(hessian)
+    vcov = lu.solve(np.eye(n_fixed + n_random, n_fixed))[:n_fixed]
+
+    # Conditional standard deviations of the random effects (diagonal of the inverse, in blocks)
+    lu_random = splu(hessian[n_fixed:, n_fixed:].tocsc())
+    cond_var = np.empty(n_random)
+    for i in range(0, n_random, 1000):
+        cols = np.arange(i, min(i + 1000, n_random))
+        rhs = np.zeros((n_random, len(cols)))
+        rhs[cols, np.arange(len(cols))] = 1
+        cond_var[cols] = lu_random.solve(rhs)[cols, np.arange(len(cols))]
+
+    lam = sigma[term_of_col]
+    ranef["condval"] = lam * coef[n_fixed:]
+    ranef["condsd"] = lam * np.sqrt(cond_var)
+
+    # Tables as in the lme4 output
+    se = np.sqrt(np.diag(vcov))
+    fixef = pd.DataFrame({"Estimate": coef[:n_fixed], "Std. Error": se, "z value": coef[:n_fixed] / se,
+                          "Pr(>|z|)": 2 * norm.sf(np.abs(coef[:n_fixed] / se))}, index=names_fixed)
+    varcorr = pd.DataFrame({"grpvar": [":".join(columns) for columns in random], "vcov": sigma**2, "sdcor": sigma})
+
+    n_params = n_fixed + len(random)
+    loglik = -0.5 * opt.fun
+    stats = pd.Series({"Log Likelihood": loglik,
+                       "AIC": 2 * n_params - 2 * loglik,
+                       "BIC": np.log(n.sum()) * n_params - 2 * loglik,
+                       "Num. obs.": n.sum(),
+                       **{f"Num. groups: {grpvar}": (ranef["grpvar"] == grpvar).sum() for grpvar in varcorr["grpvar"]}})
+
+    return {"fixef": fixef,
+            "vcov": pd.DataFrame(vcov, index=names_fixed, columns=names_fixed),
+            "ranef": ranef,
+            "varcorr": varcorr,
+            "stats": stats}
+
+
 def calculate_distance(bo):
     """
     Calculates the distance between two locations based on coordinate information.
@@ -280,3 +1334,556 @@ def calculate_distance(bo):
     bo["distance"] = 52 + np.sqrt((bo["east1"] - bo["east2"])**2 + (bo["north1"] - bo["north2"])**2)
 
     return bo
+
+
+def build_address_index(addressen):
+    """
+    Creates an index of the address histories to look up the address of every person at any date.
+
+    The address periods are sorted by person and start date and stored as flat arrays, so that 
+    `lookup_address` can answer millions of (person, date) queries with a single binary search, 
+    without filtering the address registry again.
+
+    Args:
+        addressen (pd.DataFrame): Address registry (GBAADRESOBJECTBUS) with columns `RINPERSOON`, 
+                                  `GBADATUMAANVANGADRESHOUDING`, `GBADATUMEINDEADRESHOUDING` and `RINOBJECTNUMMER`.
+
+    Returns:
+        dict: With keys `persons` (pd.Index of persons), `key` (person position * 10^8 + start date, sorted), 
+              `end` (end dates) and `object` (`RINOBJECTNUMMER`), one element per address period.
+
+    Notes:
+        - Dates are stored as integers in YYYYMMDD format. Missing end dates are set to 99999999.
+        - Periods of the same person with the same start date keep the order of the registry.
+    """
+    persons = pd.Index(np.unique(addressen["RINPERSOON"].astype(str)))
+    person = persons.get_indexer(addressen["RINPERSOON"].astype(str)).astype(np.int64)
+    start = pd.to_numeric(addressen["GBADATUMAANVANGADRESHOUDING"], errors="coerce").fillna(0).astype(np.int64).values
+    end = pd.to_numeric(addressen["GBADATUMEINDEADRESHOUDING"], errors="coerce").fillna(99999999).astype(np.int64).values
+
+    # Sort by person and start date
+    key = person * 10**8 + start
+    order = np.argsort(key, kind="stable")
+    print(f"Address index with {len(key)} periods for {len(persons)} persons")
+
+    return {"persons": persons,
+            "key": key[order],
+            "end": end[order],
+            "object": addressen["RINOBJECTNUMMER"].values[order]}
+
+
+def lookup_address(address_index, persons, dates, only_current=True):
+    """
+    Looks up the address (`RINOBJECTNUMMER`) of every person at a given date.
+
+    Args:
+        address_index (dict): Index created with `build_address_index`.
+        persons (array-like): Person codes (`RINPERSOON`).
+        dates (int or array-like): Dates in YYYYMMDD format, one for all persons or one per person.
+        only_current (bool, optional): If True, the address must not have ended on the date. If False, 
+                                       the last address started on or before the date is returned. Defaults to True.
+
+    Returns:
+        np.ndarray: The `RINOBJECTNUMMER` of every person at the date, None if not found.
+
+    Example:
+        >>> lookup_address(address_index, ["000000001", "000000002"], 20201231)
+    """
+    person = address_index["persons"].get_indexer(np.asarray(persons, dtype=str)).astype(np.int64)
+    dates = np.broadcast_to(np.asarray(dates, dtype=np.int64), person.shape)
+
+    # Last period of the person starting on or before the date
+    pos = np.searchsorted(address_index["key"], person * 10**8 + dates, side="right") - 1
+    pos_valid = np.clip(pos, 0, None)
+    found = (person >= 0) & (pos >= 0) & (address_index["key"][pos_valid] // 10**8 == person)
+    if only_current:
+        found &= address_index["end"][pos_valid] > dates
+
+    return np.where(found, address_index["object"][pos_valid], None)
+
+
+def subset_address_index(address_index, persons):
+    """
+    Selects the address histories of some persons from an address index (e.g. for one partition).
+
+    Args:
+        address_index (dict): Index created with `build_address_index`.
+        persons (array-like): Person codes (`RINPERSOON`), possibly repeated.
+
+    Returns:
+        dict: An index with the same keys as `build_address_index`, with only the periods of `persons`.
+    """
+    kept = address_index["persons"].get_indexer(pd.unique(np.asarray(persons, dtype=str)))
+    kept = np.sort(kept[kept >= 0])
+
+    # Keep the periods of the persons, and renumber the persons (the order of the keys does not change)
+    person = address_index["key"] // 10**8
+    mask = np.isin(person, kept)
+    key = np.searchsorted(kept, person[mask]).astype(np.int64) * 10**8 + address_index["key"][mask] % 10**8
+
+    return {"persons": address_index["persons"][kept],
+            "key": key,
+            "end": address_index["end"][mask],
+            "object": address_index["object"][mask]}
+
+
+def days_to_date(days):
+    """
+    Converts days from January 1, 2020 (see `read_rivm`) to dates in YYYYMMDD format.
+
+    Args:
+        days (pd.Series): Days from January 1, 2020.
+
+    Returns:
+        pd.Series: Dates as integers in YYYYMMDD format (NaN if `days` is NaN).
+    """
+    date = pd.to_datetime("2020-01-01") + pd.to_timedelta(days, unit="D")
+    return date.dt.year * 10000 + date.dt.month * 100 + date.dt.day
+
+
+def distance_at(address_index, coord, persons1, persons2, dates):
+    """
+    Calculates the distance between the addresses of two persons at a given date (e.g. the infection date).
+
+    Args:
+        address_index (dict): Index created with `build_address_index`.
+        coord (pd.Series): `VRLVIERKANT100M` indexed by `RINOBJECTNUMMER`.
+        persons1 (array-like): Person codes of the first person of every pair.
+        persons2 (array-like): Person codes of the second person of every pair.
+        dates (array-like): Dates in YYYYMMDD format, one per pair.
+
+    Returns:
+        np.ndarray: The distance between the homes of the persons (0 if they live in the same house, 
+                    NaN if an address or its coordinates are missing).
+    """
+    pairs = pd.DataFrame({"RINOBJECTNUMMER": lookup_address(address_index, persons1, dates),
+                          "RINOBJECTNUMMER2": lookup_address(address_index, persons2, dates)})
+    pairs["VRLVIERKANT100M"] = pairs["RINOBJECTNUMMER"].map(coord)
+    pairs["VRLVIERKANT100M2"] = pairs["RINOBJECTNUMMER2"].map(coord)
+
+    # Keep only valid coordinates, as in 3_analysis.py
+    valid = (pairs["VRLVIERKANT100M"].str[0] != "-") & (pairs["VRLVIERKANT100M2"].str[0] != "-")
+    pairs.loc[~valid.fillna(False).astype(bool), ["VRLVIERKANT100M", "VRLVIERKANT100M2"]] = np.nan
+
+    pairs = calculate_distance(pairs)
+    pairs.loc[pairs["RINOBJECTNUMMER"].notna() & (pairs["RINOBJECTNUMMER"] == pairs["RINOBJECTNUMMER2"]), "distance"] = 0
+    return pairs["distance"].values
+
+
+def calc_stats(df, schools=True, label="", distance="distance"):
+    """
+    Counts the pairs and the co-infected pairs in general, for different distance thresholds and (optionally) within the same postcode or municipality.
+
+    Args:
+        df (pd.DataFrame): A DataFrame containing columns `distance` and `co_infected` (and `POSTCODE1`, 
+                           `POSTCODE2`, `gemcode1` and `gemcode2` if `schools` is True).
+        schools (bool, optional): If True, includes the counts within the same school postcode and 
+                                  municipality (gemeente). Defaults to True.
+        label (str, optional): Label of the group. Defaults to an empty string.
+        distance (str, optional): Column with the distance between the homes (e.g. `distance_infection`, 
+                                  the distance at the infection date). Defaults to "distance".
+
+    Returns:
+        pd.DataFrame: One row per subset, with columns `Group`, `Distance`, `N` and `N_inf`, in the 
+                      same order as the rows of `stats_full.tsv`.
+    """
+    rows = [(label, "general", len(df), df["co_infected"].sum())]
+
+    # Threshold ranges for distance calculations
+    th_p = -1
+    for threshold in [0, 300, 1000, 3000, 10000, 30000, 300000]:
+        d_th = df.loc[(df[distance] > th_p) & (df[distance] <= threshold)]
+        rows.append((label, f"{th_p}-{threshold}", len(d_th), d_th["co_infected"].sum()))
+        th_p = threshold
+
+    # Pairs within the same postcode and municipality (gemeente)
+    if schools:
+        d_th = df.loc[df["POSTCODE1"] == df["POSTCODE2"]]
+        rows.append((label, "school_postcode", len(d_th), d_th["co_infected"].sum()))
+        d_th = df.loc[df["gemcode1"] == df["gemcode2"]]
+        rows.append((label, "school_gemeente", len(d_th), d_th["co_infected"].sum()))
+
+    stats = pd.DataFrame(rows, columns=["Group", "Distance", "N", "N_inf"])
+    stats["N_inf"] = stats["N_inf"].astype(int)
+    return stats
+
+
+def school_partition_stats(pairs, rivm, siblings, groups, address_index, coord, threshold=14, gemcode=None):
+    """
+    Adds the infections to one partition of the school pairs and counts the (co-infected) pairs of every group and subset.
+
+    Args:
+        pairs (pd.DataFrame): Pairs of the partition with columns `Group`, `RINPERSOON1`, `RINPERSOON2`, 
+                              `RINOBJECTNUMMER`, `RINOBJECTNUMMER2`, `BRIN_crypt`, `BRINVEST` and the 
+                              columns used in `calc_stats`.
+        rivm (dict): Dictionary mapping persons to days from January 1, 2020 (see `read_rivm`). 
+                     Only the persons of the partition are needed.
+        siblings (set): Pairs of siblings (`RINPERSOON1` + `RINPERSOON2`).
+        groups (list): Groups to count, in the order of the output. Groups missing in the partition 
+                       are counted as zero, so the results of all partitions have the same rows.
+        address_index (dict): Address histories of the persons of the partition (see `subset_address_index`).
+        coord (pd.Series): `VRLVIERKANT100M` indexed by `RINOBJECTNUMMER`, for the addresses of the partition.
+        threshold (int, optional): Maximum difference (exclusive) in days between infections. Defaults to 14.
+        gemcode (str, optional): Gemeente of the partition, stored in the aggregates. Defaults to None.
+
+    Returns:
+        tuple: Counts with columns `Group`, `Distance`, `N` and `N_inf` (see `calc_stats`), for 
+               the subsets "all", "twins", "infected" and "infected_twins" of every group (and 
+               "infected_at_infection", the infected pairs by the distance between the homes at the 
+               infection date), the aggregated pair counts of the partition (see `aggregate_pairs`) 
+               and the binomial cells of the school groups for the multilevel model (see `aggregate_binomial`).
+    """
+    # When the students live in the same house the distance should be 0
+    pairs.loc[pairs["RINOBJECTNUMMER"] == pairs["RINOBJECTNUMMER2"], "distance"] = 0
+
+    # Temporally associated infections (first infection of every person)
+    pairs["date_infection_1"] = pairs["RINPERSOON1"].map(rivm)
+    pairs["date_infection_2"] = pairs["RINPERSOON2"].map(rivm)
+    pairs["co_infected"] = ((pairs["date_infection_1"] - pairs["date_infection_2"]).abs() < threshold)
+    infected = ~(np.isnan(pairs["date_infection_1"]) & np.isnan(pairs["date_infection_2"]))
+    twins = (pairs["RINPERSOON1"] + pairs["RINPERSOON2"]).isin(siblings)
+
+    # Distance between the homes at the first infection of the pair (addresses can change during the year)
+    date_infection = days_to_date(np.fmin(pairs["date_infection_1"], pairs["date_infection_2"])).fillna(20201231).astype(int)
+    pairs["distance_infection"] = distance_at(address_index, coord, pairs["RINPERSOON1"], pairs["RINPERSOON2"], date_infection)
+
+    stats = []
+    for subset, keep in (("all", None), ("twins", twins), ("infected", infected), ("infected_twins", infected & twins)):
+        for group in groups:
+            keep_group = (pairs["Group"] == group) if keep is None else (pairs["Group"] == group) & keep
+            stats.append(calc_stats(pairs.loc[keep_group], schools=True, label=f"{group}_{subset}"))
+    for group in groups:
+        keep_group = (pairs["Group"] == group) & infected
+        stats.append(calc_stats(pairs.loc[keep_group], schools=True, label=f"{group}_infected_at_infection",
+                                distance="distance_infection"))
+
+    aggregates = aggregate_pairs(pairs, pairs["Group"], twins=twins, gemcode=gemcode, schools=True)
+
+    # Binomial cells (group, primary school, gemeente, distance) of the school groups (not the baseline)
+    cells = pairs.loc[pairs["Group"] != "baseline"]
+    cells = pd.DataFrame({"Group": cells["Group"].values,
+                          "gemcode": gemcode,
+                          "school_id": (cells["BRIN_crypt"].astype(str) + ":" + cells["BRINVEST"].astype(str)).values,
+                          "Distance": distance_bins(cells["distance"]).values,
+                          "co_infected": cells["co_infected"].values})
+    cells = aggregate_binomial(cells, ["Group", "gemcode", "school_id", "Distance"])
+
+    return pd.concat(stats, ignore_index=True), aggregates, cells
+
+
+def family_partition_stats(df, rivm, addressen, label, threshold=14):
+    """
+    Adds the infections and home distances to one partition of the family links and counts the (co-infected) pairs.
+
+    Args:
+        df (pd.DataFrame): Family links of the partition with columns `RINPERSOONSRC` and `RINPERSOONDST`.
+        rivm (dict): Dictionary mapping persons to days from January 1, 2020 (see `read_rivm`).
+        addressen (pd.DataFrame): Addresses with columns `RINPERSOON`, `RINOBJECTNUMMER` and `VRLVIERKANT100M`.
+        label (str): Label of the type of link (e.g. "Siblings-103").
+        threshold (int, optional): Maximum difference (exclusive) in days between infections. Defaults to 14.
+
+    Returns:
+        tuple: Counts with columns `Group`, `Distance`, `N` and `N_inf` for the subsets "all" and 
+               "infected", the pairs kept (`RINPERSOON1`, `RINPERSOON2`) and the aggregated pair 
+               counts of the partition (see `aggregate_pairs`).
+    """
+    df["date_infection_1"] = df["RINPERSOONSRC"].map(rivm)
+    df["date_infection_2"] = df["RINPERSOONDST"].map(rivm)
+
+    # Home addresses of both persons
+    df = pd.merge(df, addressen.rename(columns={"RINPERSOON": "RINPERSOONSRC"}), on="RINPERSOONSRC", validate="m:1")
+    df = pd.merge(df, addressen.rename(columns={"RINPERSOON": "RINPERSOONDST"}), on="RINPERSOONDST", suffixes=["", "2"], validate="m:1")
+
+    df["co_infected"] = ((df["date_infection_1"] - df["date_infection_2"]).abs() < threshold)
+    df["not_infected"] = np.isnan(df["date_infection_1"]) & np.isnan(df["date_infection_2"])
+    df = df.loc[(df["VRLVIERKANT100M"].str[0] != "-") & (df["VRLVIERKANT100M2"].str[0] != "-")]
+    df = calculate_distance(df)
+    df.loc[df["RINOBJECTNUMMER"] == df["RINOBJECTNUMMER2"], "distance"] = 0
+
+    stats = pd.concat([calc_stats(df, schools=False, label=f"{label}_all"),
+                       calc_stats(df.loc[~df["not_infected"]], schools=False, label=f"{label}_infected")],
+                      ignore_index=True)
+    pairs = df[["RINPERSOONSRC", "RINPERSOONDST"]].set_axis(["RINPERSOON1", "RINPERSOON2"], axis=1)
+    aggregates = aggregate_pairs(df, label, schools=False)
+    return stats, pairs, aggregates
+
+
+def write_partition(path, **kwargs):
+    """
+    Writes the keyword arguments of one partition to disk, to be loaded by its worker (see `run_partitioned`).
+
+    Args:
+        path (str): Path of the partition file. The folder is created if it does not exist.
+        **kwargs: Keyword arguments of the function run on the partition.
+
+    Returns:
+        str: The path of the partition file.
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "wb+") as f:
+        pickle.dump(kwargs, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def _run_partition_file(func, path):
+    """Loads the keyword arguments of a partition written with `write_partition` and runs the function."""
+    with open(path, "rb") as f:
+        kwargs = pickle.load(f)
+    return func(**kwargs)
+
+
+def subset_infections(rivm, persons):
+    """
+    Selects the infections of some persons (vectorized, for the partitions of `run_partitioned`).
+
+    Args:
+        rivm (pd.Series): Days from January 1, 2020 indexed by `RINPERSOON` (e.g. `pd.Series(rivm)`).
+        persons (array-like): Person codes, possibly repeated.
+
+    Returns:
+        dict: Dictionary mapping the infected persons to days from January 1, 2020 (see `read_rivm`).
+    """
+    return rivm.reindex(pd.unique(np.asarray(persons))).dropna().astype(int).to_dict()
+
+
+def run_partitioned(func, partitions, n_workers=None):
+    """
+    Runs a function on every partition in a pool of processes.
+
+    Args:
+        func (callable): Function to run. It must be importable (e.g. defined in this module) so it 
+                         can be sent to the worker processes.
+        partitions (list): Paths of the partition files (see `write_partition`), or keyword arguments 
+                           of `func` for every partition.
+        n_workers (int, optional): Number of processes. Defaults to the number of CPUs.
+
+    Returns:
+        list: The results of `func`, in the order of `partitions`.
+
+    Notes:
+        - With partition files, every worker loads only its own partition, and the parent process does 
+          not need to keep the data in memory (delete it before calling this function). The peak memory 
+          of a worker is set by the largest partition.
+        - The partition files contain pair-level data, they are deleted when the run ends (also on errors).
+    """
+    st = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [pool.submit(_run_partition_file, func, partition) if isinstance(partition, str)
+                       else pool.submit(func, **partition) for partition in partitions]
+            results = [future.result() for future in futures]
+    finally:
+        for partition in partitions:
+            if isinstance(partition, str) and os.path.exists(partition):
+                os.remove(partition)
+    print(f"{len(partitions)} partitions analyzed in {time.time() - st: 2.0f} seconds")
+    return results
+
+
+def merge_stats(stats):
+    """
+    Merges the counts of several partitions, summing `N` and `N_inf` of the same group and distance.
+
+    Args:
+        stats (list): DataFrames with columns `Group`, `Distance`, `N` and `N_inf` (see `calc_stats`).
+
+    Returns:
+        pd.DataFrame: The merged counts, in the order of the first partition.
+    """
+    return pd.concat(stats, ignore_index=True).groupby(["Group", "Distance"], sort=False)[["N", "N_inf"]].sum().reset_index()
+
+
+def cluster_bootstrap_ci(stats_clusters, n_boot=2000, alpha=0.05, seed=0):
+    """
+    Calculates cluster-robust confidence intervals of the proportion of co-infected pairs with a cluster bootstrap.
+
+    Pairs from the same school or municipality are not independent, so the clusters (not the pairs) 
+    are resampled. Every replicate is a vector of multinomial weights (how many times each cluster is 
+    drawn), and the proportions of all replicates are computed at once from the per-cluster sums of 
+    `N` and `N_inf`, without going back to the pairs.
+
+    Args:
+        stats_clusters (pd.DataFrame): Counts per cluster, with columns `Group`, `Distance`, `cluster`, 
+                                       `N` and `N_inf` (see `calc_stats`).
+        n_boot (int, optional): Number of bootstrap replicates. Defaults to 2000.
+        alpha (float, optional): Significance level. Defaults to 0.05 (95% interval).
+        seed (int, optional): Seed of the random number generator. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: One row per group and distance, with columns `Group`, `Distance`, `N`, `N_inf`, 
+                      `ci_low` and `ci_high` (percentile interval, expressed as percentages).
+
+    Notes:
+        - The clusters of every group are resampled separately. All clusters of a group are used, 
+          also those without pairs for some distances.
+    """
+    rng = np.random.default_rng(seed)
+    st = time.time()
+
+    cis = []
+    for group, df in stats_clusters.groupby("Group", sort=False):
+        # Sums per distance (rows) and cluster (columns)
+        N = df.pivot_table(index="Distance", columns="cluster", values="N", aggfunc="sum", fill_value=0, sort=False)
+        N_inf = df.pivot_table(index="Distance", columns="cluster", values="N_inf", aggfunc="sum", fill_value=0, sort=False)
+        N_inf = N_inf.reindex(index=N.index, columns=N.columns)
+
+        # Multinomial weights of the clusters (replicates x clusters) and proportions of every replicate
+        n_clusters = N.shape[1]
+        weights = rng.multinomial(n_clusters, np.full(n_clusters, 1 / n_clusters), size=n_boot)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            prop = (weights @ N_inf.values.T) / (weights @ N.values.T)
+        prop[~np.isfinite(prop)] = np.nan
+
+        # Percentile intervals (NaN if there are no pairs in any replicate)
+        ci = np.full((2, len(N)), np.nan)
+        valid = ~np.all(np.isnan(prop), axis=0)
+        ci[:, valid] = np.nanpercentile(prop[:, valid], [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+
+        cis.append(pd.DataFrame({"Group": group, "Distance": N.index, "N": N.sum(axis=1).values,
+                                 "N_inf": N_inf.sum(axis=1).values, "ci_low": 100 * ci[0], "ci_high": 100 * ci[1]}))
+
+    print(f"Cluster bootstrap ({n_boot} replicates) for {stats_clusters['Group'].nunique()} groups in {time.time() - st: 2.0f} seconds")
+    return pd.concat(cis, ignore_index=True)
+
+
+def aggregate_pairs(df, group, twins=None, gemcode=None, schools=True, max_days=28):
+    """
+    Counts the pairs per group, subset flags, distance range, days between infections and gemeente.
+
+    The counts are the sufficient statistics of all proportions in `stats_full.tsv`: the number of 
+    co-infected pairs for any threshold up to `max_days` is the sum of the counts with fewer days 
+    between infections (see `query_aggregates`).
+
+    Args:
+        df (pd.DataFrame): Pairs with columns `date_infection_1`, `date_infection_2` and `distance` 
+                           (and `POSTCODE1`, `POSTCODE2`, `gemcode1` and `gemcode2` if `schools` is True).
+        group (str or pd.Series): Group of the pairs.
+        twins (pd.Series, optional): True for pairs of siblings. Defaults to None (all False).
+        gemcode (str, optional): Gemeente of the pairs (partition). Defaults to None.
+        schools (bool, optional): If True, adds the flags `same_postcode` and `same_gemeente` of the 
+                                  schools. Defaults to True.
+        max_days (int, optional): Days between infections are capped at this value. Defaults to 28.
+
+    Returns:
+        pd.DataFrame: One row per cell, with columns `Group`, `twins`, `Distance` (see `distance_bins`), 
+                      `days` (days between infections, -1 if only one person was infected and -2 if 
+                      none), `gemcode`, `same_postcode`, `same_gemeente` and `N`.
+    """
+    date_infection_1, date_infection_2 = df["date_infection_1"].values, df["date_infection_2"].values
+    days = np.abs(date_infection_1 - date_infection_2)
+    days = np.where(np.isnan(date_infection_1) & np.isnan(date_infection_2), -2,
+                    np.where(np.isnan(days), -1, np.minimum(np.nan_to_num(days), max_days))).astype(np.int8)
+
+    cells = pd.DataFrame({"Group": np.asarray(group) if not isinstance(group, str) else group,
+                          "twins": False if twins is None else np.asarray(twins, dtype=bool),
+                          "Distance": distance_bins(df["distance"]).values,
+                          "days": days,
+                          "gemcode": gemcode,
+                          "same_postcode": (df["POSTCODE1"] == df["POSTCODE2"]).values if schools else False,
+                          "same_gemeente": (df["gemcode1"] == df["gemcode2"]).values if schools else False},
+                         index=np.arange(len(df)))
+    return cells.groupby(AGGREGATE_COLUMNS, observed=True, dropna=False).size().rename("N").reset_index()
+
+
+# Columns identifying the cells of the aggregate store (see `aggregate_pairs`)
+AGGREGATE_COLUMNS = ["Group", "twins", "Distance", "days", "gemcode", "same_postcode", "same_gemeente"]
+
+
+def build_aggregate_store(aggregates, max_days=28):
+    """
+    Merges the aggregated pair counts of several partitions into one indexed store.
+
+    Args:
+        aggregates (list): DataFrames created with `aggregate_pairs`.
+        max_days (int, optional): The `max_days` used in `aggregate_pairs`, stored in `store.attrs`. Defaults to 28.
+
+    Returns:
+        pd.DataFrame: The summed counts, indexed by a sorted (`Group`, `Distance`) MultiIndex, with the 
+                      other cell columns and `N` (persist it with pickle).
+    """
+    store = pd.concat(aggregates, ignore_index=True)
+    for column in ["Group", "Distance", "gemcode"]:
+        store[column] = store[column].astype(object).astype("category")
+    store = store.groupby(AGGREGATE_COLUMNS, observed=True, dropna=False)["N"].sum().reset_index()
+    store = store.set_index(["Group", "Distance"]).sort_index()
+    store.attrs["max_days"] = max_days
+    print(f"Aggregate store: {len(store)} cells for {store['N'].sum()} pairs")
+    return store
+
+
+def query_aggregates(store, by=("Group",), groups=None, twins=None, infected=None, distances=None,
+                     gemcodes=None, same_postcode=None, same_gemeente=None, threshold=14, ci="normal", n_boot=2000):
+    """
+    Calculates the number of pairs, co-infected pairs, rates and confidence intervals of any subset of the aggregate store.
+
+    Args:
+        store (pd.DataFrame): Aggregate store (see `build_aggregate_store`).
+        by (tuple, optional): Columns to group the results by (e.g. `("Group", "Distance")`). Use `()` 
+                              to sum all selected pairs. Defaults to `("Group",)`.
+        groups (list, optional): Groups to keep (e.g. `["same_class", "baseline"]`). Defaults to all.
+        twins (bool, optional): Keep only pairs of siblings (True) or non-siblings (False). Defaults to all.
+        infected (bool, optional): Keep only pairs with at least one infection (True) or none (False). Defaults to all.
+        distances (list, optional): Distance ranges to keep, merged (e.g. `["0-300", "300-1000"]`). Defaults to all.
+        gemcodes (list, optional): Gemeentes to keep. Defaults to all.
+        same_postcode (bool, optional): Keep only pairs of schools in the same (True) or different postcode. Defaults to all.
+        same_gemeente (bool, optional): Keep only pairs of schools in the same (True) or different gemeente. Defaults to all.
+        threshold (int, optional): Maximum difference (exclusive) in days between infections, at most 
+                                   the `max_days` of the store. Defaults to 14.
+        ci (str, optional): "normal" (as `calc_prop`) or "cluster" (bootstrap of the gemeentes, see 
+                            `cluster_bootstrap_ci`). Family pairs have no gemeente, so use "cluster" 
+                            only for school groups. Defaults to "normal".
+        n_boot (int, optional): Number of bootstrap replicates if `ci` is "cluster". Defaults to 2000.
+
+    Returns:
+        pd.DataFrame: One row per combination of `by`, with columns `N`, `N_inf`, `prop_inf`, `ci_low` 
+                      and `ci_high` (as percentages).
+
+    Raises:
+        ValueError: If `threshold` is larger than the `max_days` of the store (the days between 
+                    infections are capped at `max_days`).
+
+    Example:
+        >>> query_aggregates(store, groups=["same_class", "baseline"], infected=True, distances=["0-300", "300-1000"])
+    """
+    by = list(by)
+    max_days = store.attrs.get("max_days", 28)
+    if threshold > max_days:
+        raise ValueError(f"threshold ({threshold}) larger than the days between infections in the store (max_days={max_days})")
+
+    # Select the groups and distances with the sorted index, and the other cells with masks
+    if groups is not None or distances is not None:
+        key = tuple(slice(None) if values is None else store.index.unique(level).intersection(values).tolist()
+                    for level, values in (("Group", groups), ("Distance", distances)))
+        store = store.loc[key, :] if all(len(k) > 0 for k in key if isinstance(k, list)) else store.iloc[:0]
+    store = store.reset_index()
+    mask = np.ones(len(store), dtype=bool)
+    if gemcodes is not None:
+        mask &= store["gemcode"].isin(gemcodes).values
+    for column, value in (("twins", twins), ("same_postcode", same_postcode), ("same_gemeente", same_gemeente)):
+        if value is not None:
+            mask &= (store[column] == value).values
+    if infected is not None:
+        mask &= (store["days"] != -2).values if infected else (store["days"] == -2).values
+    selected = store.loc[mask]
+
+    # Co-infected pairs for the threshold
+    selected = selected.assign(N_inf=selected["N"] * ((selected["days"] >= 0) & (selected["days"] < threshold)),
+                               total="total")
+    keys = by if len(by) > 0 else ["total"]
+    result = selected.groupby(keys, observed=True)[["N", "N_inf"]].sum()
+    result["prop_inf"] = 100 * result["N_inf"] / result["N"]
+
+    if ci == "cluster":
+        # Counts per gemeente as clusters, with the combinations of `by` as groups
+        stats_clusters = selected.groupby(keys + ["gemcode"], observed=True)[["N", "N_inf"]].sum().reset_index()
+        stats_clusters["Group"] = stats_clusters[keys].astype(str).agg("|".join, axis=1)
+        stats_clusters = stats_clusters.assign(Distance="all").rename(columns={"gemcode": "cluster"})
+        cis = cluster_bootstrap_ci(stats_clusters, n_boot=n_boot).set_index("Group")
+        labels = pd.Index(result.index.to_frame().astype(str).agg("|".join, axis=1))
+        result["ci_low"] = cis["ci_low"].reindex(labels).values
+        result["ci_high"] = cis["ci_high"].reindex(labels).values
+    else:
+        ci_low, ci_high = proportion_confint(result["N_inf"].values, result["N"].values)
+        result["ci_low"], result["ci_high"] = 100 * np.asarray(ci_low), 100 * np.asarray(ci_high)
+
+    return result.reset_index().drop(columns="total", errors="ignore")